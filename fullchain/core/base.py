@@ -6,6 +6,16 @@ from fullchain.io.memorystream import StreamManager
 
 
 class Model:
+    # Attributes carried through pickle, __dict__ is the JSON view of the model
+    _pickled = ()
+
+    def __getstate__(self):
+        return {name: getattr(self, name) for name in self._pickled}
+
+    def __setstate__(self, state):
+        for name, value in state.items():
+            setattr(self, name, value)
+
     @property
     def __dict__(self) -> dict:
         raise NotImplementedError()
@@ -1,18 +1,60 @@
 import binascii
 import collections
 import hashlib
-import math
+import struct
 
 from fullchain.core.base import Model
-from fullchain.core.exceptions import BlockInvalidException, BlockSerializeException
+from fullchain.core.exceptions import BlockInvalidException
+from fullchain.core.merkle import MerkleTree
 from fullchain.core.transaction import Transaction
 from fullchain.io.binaryreader import BinaryReader
 from fullchain.io.binarywriter import BinaryWriter
 
 
+class BlockHeader:
+    # prevBlockHash, txRoot, height, nonce
+    FORMAT = '>32s32sIQ'
+    SIZE = struct.calcsize(FORMAT)
+
+    def __init__(self, prevBlockHash: bytes, txRoot: bytes, height: int, nonce: int):
+        self._prevBlockHash = prevBlockHash
+        self._txRoot = txRoot
+        self._height = height
+        self._nonce = nonce
+
+    @property
+    def prevBlockHash(self):
+        return self._prevBlockHash
+
+    @property
+    def txRoot(self):
+        # Merkle root over the coinbase followed by every transaction of the block
+        return self._txRoot
+
+    @property
+    def height(self):
+        return self._height
+
+    @property
+    def nonce(self):
+        return self._nonce
+
+    def getRawHeader(self) -> bytes:
+        return struct.pack(BlockHeader.FORMAT, self._prevBlockHash, self._txRoot, self._height, self._nonce)
+
+    def getHash(self) -> bytes:
+        return hashlib.sha256(self.getRawHeader()).digest()
+
+    @staticmethod
+    def fromRawHeader(raw: bytes):
+        return BlockHeader(*struct.unpack(BlockHeader.FORMAT, raw))
+
+
 class Block(Model):
     COINBASE = 25
 
+    _pickled = ('_coinbase', '_prevBlockHash', '_height', '_txs', '_hash', '_nonce', '_merkle')
+
     def __init__(
             self,
             prevBlockHash: bytes = None,
@@ -23,7 +65,11 @@ class Block(Model):
             nonce: int = None,
     ):
 
-        coinbase = Transaction.NewCoinbase(Block.COINBASE, address)
+        # Blocks created empty are filled by deserialize
+        if address is not None:
+            coinbase = Transaction.NewCoinbase(Block.COINBASE, address)
+        else:
+            coinbase = Transaction()
 
         self._coinbase = coinbase
         
@@ -41,7 +87,9 @@ class Block(Model):
             self._nonce = 0
         else:
             self._nonce = nonce
-        self.finalize()
+        self._merkle = None
+        if prevBlockHash is not None:
+            self.finalize()
 
 
     
@@ -73,23 +121,46 @@ class Block(Model):
 
     def addTransaction(self, tx):
         self._txs.append(tx)
-
-    def getRawBlock(self):
-        rawBlock = b""
-        rawBlock += self._prevBlockHash
-        
-        number_of_bytes = int(math.ceil(self._nonce.bit_length() / 8))
-        rawBlock += (self._nonce).to_bytes(number_of_bytes, 'big')
-        rawBlock += (self._height).to_bytes(2, 'big')
-        rawBlock += self._coinbase.getRawTx()
-        for tx in self._txs:
-            rawBlock += tx.getRawTx()
-        return rawBlock
+        if self._merkle is not None:
+            self._merkle.append(Block.getTxId(tx))
+
+    @staticmethod
+    def getTxId(tx) -> bytes:
+        return tx.getRawHash()
+
+    def getMerkleTree(self) -> MerkleTree:
+        # Leaf 0 is the coinbase, leaf i + 1 is getTransaction(i). Built once and
+        # then extended by addTransaction, so changing the nonce and rehashing
+        # the header costs the same whatever the block size
+        if self._merkle is None:
+            leaves = [Block.getTxId(self._coinbase)]
+            leaves.extend(Block.getTxId(tx) for tx in self._txs)
+            self._merkle = MerkleTree(leaves)
+        return self._merkle
+
+    def getTxRoot(self):
+        return self.getMerkleTree().getRoot()
+
+    def getTransactionProof(self, index: int):
+        """
+        Proof that getTransaction(index) is committed to by the header, check it
+        with Block.verifyTransactionProof.
+        """
+        tree = self.getMerkleTree()
+        return tree.getProof(index + 1), len(tree)
+
+    @staticmethod
+    def verifyTransactionProof(header: BlockHeader, tx, index: int, size: int, proof: list) -> bool:
+        return MerkleTree.verifyProof(Block.getTxId(tx), index + 1, size, proof, header.txRoot)
+
+    def getHeader(self) -> BlockHeader:
+        return BlockHeader(self._prevBlockHash, self.getTxRoot(), self._height, self._nonce)
+
+    def getRawHeader(self) -> bytes:
+        return self.getHeader().getRawHeader()
 
     def finalize(self):
-        md = hashlib.sha256()
-        md.update(self.getRawBlock())
-        self._hash = md.digest()
+        self._hash = self.getHeader().getHash()
 
     
     def isGenesis(self) -> bool:
@@ -97,10 +168,7 @@ class Block(Model):
 
     
     def isValid(self) -> bool:
-        md = hashlib.sha256()
-        md.update(self.getRawBlock())
-        hashed_raw_block = md.digest()
-        return self.getHash == hashed_raw_block
+        return self.getHash() == self.getHeader().getHash()
 
     
     def __dict__(self) -> dict:
@@ -117,12 +185,11 @@ class Block(Model):
         return collections.OrderedDict(sorted(unordered.items()))
 
     def serialize(self, writer: BinaryWriter):
-        writer.writeBytes(self.getPrevBlockHash)
+        writer.writeBytes(self.getPrevBlockHash(), unhex=False)
         self.getCoinbase().serialize(writer)
-        writer.writeBool(self.getCoinbase)
-        writer.writeUInt32(self.getHeight)
-        writer.writeUInt32(self.getNonce)
-        writer.writeSerializableArray(self.getTransactions)
+        writer.writeUInt32(self.getHeight())
+        writer.writeUInt64(self.getNonce())
+        writer.writeSerializableArray(self.getTransactions())
 
     def deserialize(self, reader: BinaryReader):
         self._prevBlockHash = reader.readBytes(32)
@@ -130,7 +197,8 @@ class Block(Model):
         coinbase.deserialize(reader)
         self._coinbase = coinbase
         self._height = reader.readUInt32()
-        self._nonce = reader.readUInt32()
+        self._nonce = reader.readUInt64()
+        self._merkle = None
         self._txs = []
         transaction_length = reader.readVarInt()
 
@@ -139,5 +207,5 @@ class Block(Model):
             txn = txn.deserialize(reader)
             self._txs.append(txn)
 
-        if self.isValid:
-            raise BlockSerializeException
+        # The hash is not serialized, it is the hash of the header
+        self.finalize()
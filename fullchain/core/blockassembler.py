@@ -0,0 +1,94 @@
+import heapq
+import itertools
+
+from fullchain.core import settings
+from fullchain.core.transactionpool import TransactionPool
+
+
+class BlockAssembler:
+    """
+    Picks the pooled transactions of a block template by ancestor package
+    fee rate, as Bitcoin Core does: a transaction comes with the pooled
+    ancestors it needs, parents first, so a child paying for its parent
+    pulls the parent in. The pool keeps its ancestor fee rate heap up to
+    date as transactions come and go, so every round starts from a copy of
+    that ordering and costs O(n log n).
+    """
+    # Room left for the header and the coinbase
+    RESERVED_BYTES = 1024
+
+    def __init__(self, pool: TransactionPool, maxBytes: int = None):
+        self._pool = pool
+        self._maxBytes = maxBytes if maxBytes is not None else settings.MAX_BLOCK_BYTES - BlockAssembler.RESERVED_BYTES
+
+    @property
+    def maxBytes(self):
+        return self._maxBytes
+
+    def getPackage(self, txHash, included):
+        # txHash and its pooled ancestors not in included, parents first
+        pool = self._pool
+        package = []
+        seen = set()
+        stack = [(txHash, False)]
+        while stack:
+            current, expanded = stack.pop()
+            if expanded:
+                package.append(current)
+                continue
+            if current in seen or current in included:
+                continue
+            seen.add(current)
+            stack.append((current, True))
+            for parent in pool.getParents(pool.getEntry(current).tx):
+                stack.append((parent, False))
+        return package
+
+    def assemble(self, maxBytes: int = None):
+        """
+        :param maxBytes: <int> Most bytes of transactions in the template
+        :return: <list> Transactions to mine, every parent before its children
+        """
+        pool = self._pool
+        if maxBytes is None:
+            maxBytes = self._maxBytes
+        candidates = pool.getCandidates()
+        # hash -> (fee, size, tag) of packages with ancestors already in the
+        # template; tags are negative so they never match a pool version
+        modified = dict()
+        tags = itertools.count(-1, -1)
+        included = set()
+        template = []
+        size = 0
+        while candidates:
+            item = heapq.heappop(candidates)
+            txHash = item[3]
+            if txHash in included:
+                continue
+            if txHash in modified:
+                if modified[txHash][2] != item[2]:
+                    continue
+            elif not pool.isCurrentScore(item):
+                continue
+            package = self.getPackage(txHash, included)
+            packageSize = sum(pool.getEntry(member).size for member in package)
+            if size + packageSize > maxBytes:
+                continue
+            for member in package:
+                entry = pool.getEntry(member)
+                included.add(member)
+                template.append(entry.tx)
+                size += entry.size
+            for member in package:
+                entry = pool.getEntry(member)
+                for descendant in pool.getDescendants(member):
+                    if descendant in included:
+                        continue
+                    other = pool.getEntry(descendant)
+                    fee, packageSize, _ = modified.get(descendant, (other.ancestorFee, other.ancestorSize, 0))
+                    fee -= entry.fee
+                    packageSize -= entry.size
+                    tag = next(tags)
+                    modified[descendant] = (fee, packageSize, tag)
+                    heapq.heappush(candidates, (-(fee / packageSize), other.sequence, tag, descendant))
+        return template
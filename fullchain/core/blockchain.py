@@ -1,17 +1,99 @@
-from fullchain.core.block import Block
+import collections
+import decimal
+import hashlib
+import multiprocessing
+import threading
+import time
+
+from fullchain.core import settings
+from fullchain.core.block import Block, BlockHeader
+from fullchain.core.blockindex import BlockIndexEntry
+from fullchain.core.crypto import BatchVerifier
+from fullchain.core.orphanpool import OrphanPool
+from fullchain.core.pow import difficulty_to_work, validate_proof_of_work
 from fullchain.core.transaction import Transaction
-from fullchain.core.transactionpool import TransactionPool
-from fullchain.core.txhandler import TxHandler
+from fullchain.core.transactionpool import MempoolUTXOView, TransactionPool
+from fullchain.core.txhandler import TxHandler, ValidationStats
+from fullchain.core.utxo import UTXO
 from fullchain.core.state import BlockChainState
+from fullchain.io.helper import Helper
+from fullchain.storage.access.blockaccessor import getBlockByHash, getHeaderByHeight, storeBlock, storeBlocks
+from fullchain.logs.logging import log_manager
+
+logger = log_manager.getLogger()
+
+def _prepareBlock(item):
+    # Runs in the addBlocks workers: parsing and checks that need no chain state
+    if isinstance(item, Block):
+        blk = item
+    else:
+        blk = Helper.AsSerializableWithType(item, 'fullchain.core.block.Block')
+        if blk is None:
+            return None
+    for tx in blk.getTransactions():
+        if not TxHandler.checkStructure(tx):
+            return None
+    # Fills the cached encodings, hashes and Merkle tree before shipping back
+    blk.getTxRoot()
+    return blk
+
+def _prepareBlocks(items):
+    return [_prepareBlock(item) for item in items]
+
+def _prepareAhead(pool, blocks, batchSize: int, depth: int):
+    # Yields _prepareBlock of every item in order with at most depth batches
+    # in the workers, blocks are only read from the iterable as fast as they
+    # are consumed
+    pending = collections.deque()
+    batch = []
+    for item in blocks:
+        batch.append(item)
+        if len(batch) < batchSize:
+            continue
+        pending.append(pool.apply_async(_prepareBlocks, (batch,)))
+        batch = []
+        if len(pending) >= depth:
+            yield from pending.popleft().get()
+    if batch:
+        pending.append(pool.apply_async(_prepareBlocks, (batch,)))
+    while pending:
+        yield from pending.popleft().get()
+
 # import base.transaction as tx
 class BlockChain:
-    CUT_OFF_AGE = 10
+    CUT_OFF_AGE = settings.CUT_OFF_AGE
     DIFFICULTY = 4
-    def __init__(self, genesisBlock: Block):
+    # {height: block hash} of the main chain from settings, no block may fork
+    # below the highest checkpoint the chain has reached
+    CHECKPOINTS = {height: bytes.fromhex(blkHash) for height, blkHash in settings.CHECKPOINTS.items()}
+    def __init__(self, genesisBlock: Block, verifyWorkers: int = None, db=None, cutOffAge: int = None,
+                 assumeValid: bytes = None, checkpoints: dict = None):
         #IMPLEMENT THIS
         #---SOLUTION---
-        self._state = BlockChainState(genesisBlock)
+        self._state = BlockChainState(genesisBlock, difficulty_to_work(BlockChain.DIFFICULTY))
         self._txPool = TransactionPool()
+        self._orphans = OrphanPool()
+        if not verifyWorkers:
+            verifyWorkers = settings.VERIFY_WORKERS or multiprocessing.cpu_count()
+        # Signatures of connected blocks are checked in batches over a process pool
+        self._verifier = BatchVerifier(verifyWorkers) if verifyWorkers > 1 else None
+        self._validationStats = ValidationStats()
+        self._admissionStats = ValidationStats()
+        # Final blocks are written to db and dropped from memory
+        self._db = db
+        self._cutOffAge = cutOffAge if cutOffAge is not None else BlockChain.CUT_OFF_AGE
+        # Set by addBlocks to write final blocks in batches
+        self._storeQueue = None
+        # Called with the new latest view whenever it changes
+        self._tipListeners = []
+        # The RPC server reads the chain from its own threads
+        self._lock = threading.RLock()
+        if assumeValid is None and settings.ASSUME_VALID:
+            assumeValid = bytes.fromhex(settings.ASSUME_VALID)
+        self._assumeValid = assumeValid
+        self._checkpoints = checkpoints if checkpoints is not None else BlockChain.CHECKPOINTS
+        if db is not None:
+            storeBlock(db, genesisBlock)
         return
         #---SOLUTION---
 
@@ -19,6 +101,11 @@ class BlockChain:
     def state(self):
         return self._state
 
+    @property
+    def lock(self):
+        # Held around every change of the chain and of its transaction pool
+        return self._lock
+
     def getMaxHeightBlock(self):
         #IMPLEMENT THIS
         #---SOLUTION---
@@ -28,9 +115,27 @@ class BlockChain:
     def getMaxHeightUTXOPool(self):
         #IMPLEMENT THIS
         #---SOLUTION---
-        return self._state._latestView._utxos
+        return self._state.utxos
         #---SOLUTION---
     
+    def addTipListener(self, listener):
+        self._tipListeners.append(listener)
+
+    def getValidationStats(self):
+        return self._validationStats
+
+    def getAdmissionStats(self):
+        # Stages of the transactions checked on their way into the pool
+        return self._admissionStats
+
+    def getOrphanPool(self):
+        return self._orphans
+
+    def getOrphanParents(self):
+        # Hashes of the blocks that orphans are waiting for
+        with self._lock:
+            return self._orphans.getMissingParents()
+
     def getTransactionPool(self):
         #IMPLEMENT THIS
         #---SOLUTION---
@@ -40,33 +145,371 @@ class BlockChain:
     def addBlock(self, blk: Block):
         #IMPLEMENT THIS
         #---SOLUTION---
+        with self._lock:
+            if not self._connectBlock(blk):
+                return False
+            # Orphans waiting for this block, and then for them, connect in turn
+            parents = [blk._hash]
+            while parents:
+                for child in self._orphans.popChildren(parents.pop()):
+                    if self._connectBlock(child):
+                        parents.append(child._hash)
+            return True
+        #---SOLUTION---
+
+    def _connectBlock(self, blk: Block):
         blkHeight = blk._height
         blkHash = blk._hash
         prevHash = blk._prevBlockHash
         blkTxs = blk._txs
+        # The hash must be the one of the header, a block changed after
+        # finalize would be stored and served under a hash it does not have
+        if not blk.isValid():
+            return False
+        if not self.checkCheckpoints(blkHash, blkHeight):
+            return False
         prevView = self._state.GetViewByHash(prevHash)
         if prevView is None:
+            # Kept until the parent arrives, unless it is too old to ever connect
+            if blkHeight > self._state.finalView.height + 1:
+                self._orphans.addBlock(blk)
             return False
         view = self._state.GetViewByHash(blkHash)
         if not view is None:
             return False
         if blkHeight != prevView.height + 1:
             return False
-        if blkHeight > BlockChain.CUT_OFF_AGE:
+        if blkHeight <= self._state.finalView.height:
             return False
-        handler = TxHandler(prevView._utxos)
+        # The work credited below must have been done, addHeader already
+        # checked it for headers indexed ahead of their block
+        entry = self._state.index.get(blkHash)
+        if entry is None or not entry.isValid(BlockIndexEntry.HAVE_HEADER):
+            if not validate_proof_of_work(prevView.blk.getNonce(), prevHash, blk.getNonce(), BlockChain.DIFFICULTY):
+                return False
+        handler = TxHandler(prevView.utxos, self._verifier, self._validationStats,
+                            not self.isAssumedValid(blkHash, blkHeight))
         validTxs = handler.handleTxs(blkTxs)
         if len(validTxs) != len(blkTxs):
+            # A header already indexed for it must not stay the best header
+            entry = self._state.index.get(blkHash)
+            if entry is not None:
+                self._state.index.invalidate(entry)
             return False
-        self._state.AddView(Block)
-        if blkHeight >= self._state._latestView.height():
-            self._state.UpdateLatestView(blkHash)
+        self._state.AddView(blk, handler.getUTXOPool(), difficulty_to_work(BlockChain.DIFFICULTY))
+        best = self._state.GetBestView()
+        if best is not self._state.latestView:
+            self.reorganize(best.hash)
+            self.updateFinalView()
         return True
-        #---SOLUTION---
 
-    def addTransaction(self, tx: Transaction):
+    def addHeader(self, header: BlockHeader) -> bool:
+        """
+        Indexes a header whose parent is known once its proof of work checks
+        against the parent header. The block data is connected later with
+        addBlock, the most work header chain tells which blocks to fetch.
+        """
+        with self._lock:
+            index = self._state.index
+            blkHash = header.getHash()
+            entry = index.get(blkHash)
+            if entry is not None:
+                return entry.isValid(BlockIndexEntry.HAVE_HEADER)
+            if not self.checkCheckpoints(blkHash, header.height):
+                return False
+            parent = index.get(header.prevBlockHash)
+            if parent is None or parent.header is None or not parent.isValid(BlockIndexEntry.HAVE_HEADER):
+                return False
+            if header.height != parent.height + 1:
+                return False
+            if not validate_proof_of_work(parent.header.nonce, parent.hash, header.nonce, BlockChain.DIFFICULTY):
+                return False
+            index.addEntry(blkHash, header.prevBlockHash, header.height, difficulty_to_work(BlockChain.DIFFICULTY),
+                           BlockIndexEntry.HAVE_HEADER, header)
+            return True
+
+    def addHeaders(self, rawHeaders) -> int:
+        # Number of headers accepted, stops at the first invalid one
+        accepted = 0
+        for raw in rawHeaders:
+            if len(raw) != BlockHeader.SIZE or not self.addHeader(BlockHeader.fromRawHeader(raw)):
+                break
+            accepted += 1
+        return accepted
+
+    def getLocator(self):
+        """
+        [height, hash] pairs along the best header chain, every block near
+        the tip then doubling the step back to the final block. A peer
+        answers from the first pair that is on its own chain.
+        """
+        with self._lock:
+            final = self._state.finalView
+            entry = self._state.index.getBestHeader()
+            locator = []
+            step = 1
+            while entry is not None and entry.height > final.height:
+                locator.append([entry.height, entry.hash])
+                if len(locator) >= 10:
+                    step *= 2
+                entry = entry.getAncestor(max(entry.height - step, final.height))
+            locator.append([final.height, final.hash])
+            return locator
+
+    def getMainChainHeader(self, height: int):
+        # Raw header of the latest chain at height, final ones come from db
+        latest = self._state.latestView
+        if self._state.finalView.height <= height <= latest.height:
+            return latest.entry.getAncestor(height).header.getRawHeader()
+        if self._db is not None and 0 <= height < self._state.finalView.height:
+            return getHeaderByHeight(self._db, height)
+        return None
+
+    def getHeaders(self, locator, limit: int):
+        # Raw headers of the latest chain after the first locator entry on it
+        with self._lock:
+            start = None
+            for height, blkHash in locator:
+                raw = self.getMainChainHeader(height)
+                if raw is not None and hashlib.sha256(raw).digest() == blkHash:
+                    start = height
+                    break
+            if start is None:
+                return []
+            end = min(start + limit, self._state.latestView.height)
+            return [self.getMainChainHeader(height) for height in range(start + 1, end + 1)]
+
+    def getBlock(self, blkHash: bytes):
+        with self._lock:
+            view = self._state.GetViewByHash(blkHash)
+            if view is not None:
+                return view.blk
+            if self._db is not None:
+                return getBlockByHash(self._db, blkHash)
+            return None
+
+    def getMissingBlocks(self):
+        # Hashes of the blocks of the best header chain still to connect, in height order
+        with self._lock:
+            best = self._state.index.getBestHeader()
+            if best is None or best.chainWork <= self._state.latestView.chainWork:
+                return []
+            hashes = []
+            entry = best
+            while entry is not None and not entry.isValid(BlockIndexEntry.HAVE_DATA):
+                hashes.append(entry.hash)
+                entry = entry.parent
+            hashes.reverse()
+            return hashes
+
+    def checkCheckpoints(self, blkHash: bytes, blkHeight: int) -> bool:
+        """
+        Cheap rejection of forks before any validation: a block at a
+        checkpoint height must be the checkpoint, and once the chain has
+        reached a checkpoint nothing may attach at or below its height.
+        """
+        checkpoint = self._checkpoints.get(blkHeight)
+        if checkpoint is not None and checkpoint != blkHash:
+            return False
+        latestHeight = self._state.latestView.height
+        for height in self._checkpoints:
+            if blkHeight <= height <= latestHeight:
+                return False
+        return True
+
+    def isAssumedValid(self, blkHash: bytes, blkHeight: int) -> bool:
+        """
+        Whether blk is the assume-valid block or one of its ancestors, as far
+        as the block index knows the assume-valid block and its chain.
+        """
+        if self._assumeValid is None:
+            return False
+        entry = self._state.index.get(self._assumeValid)
+        if entry is None or entry.height < blkHeight:
+            return False
+        ancestor = entry.getAncestor(blkHeight)
+        return ancestor is not None and ancestor.hash == blkHash
+
+    def updateFinalView(self):
+        """
+        Keeps views for the last CUT_OFF_AGE blocks only. Older blocks of the
+        latest chain are final, they are written to the database and their
+        views, index entries and competing branches leave memory, so memory
+        stays flat however long the chain grows.
+        """
+        latest = self._state.latestView
+        finalHeight = latest.height - self._cutOffAge
+        if finalHeight <= self._state.finalView.height:
+            return
+        final = latest.entry.getAncestor(finalHeight)
+        finalized = self._state.UpdateFinalView(final.hash, finalHeight)
+        if self._db is None:
+            return
+        if self._storeQueue is not None:
+            self._storeQueue.extend(view.blk for view in finalized)
+            return
+        for view in finalized:
+            storeBlock(self._db, view.blk)
+
+    def addBlocks(self, blocks, workers: int = None, chunkSize: int = None):
+        """
+        Bulk import for initial sync and replays from disk. Serialized blocks
+        are parsed and checked statelessly by a process pool that keeps a few
+        batches ahead while the blocks are connected in order here, and the
+        blocks finalized by each chunk are stored in one write batch.
+        :param blocks: iterable of Block or serialized block bytes, parents first
+        :return: number of blocks connected
+        """
+        if not workers:
+            workers = settings.IMPORT_WORKERS or multiprocessing.cpu_count()
+        if not chunkSize:
+            chunkSize = settings.IMPORT_CHUNK_SIZE
+        pool = multiprocessing.Pool(workers) if workers > 1 else None
+        if pool is not None:
+            prepared = _prepareAhead(pool, blocks, 16, 2 * workers)
+        else:
+            prepared = map(_prepareBlock, blocks)
+
+        connected = 0
+        txCount = 0
+        seen = 0
+        began = time.time()
+        self._storeQueue = []
+        try:
+            for blk in prepared:
+                seen += 1
+                if blk is not None and self.addBlock(blk):
+                    connected += 1
+                    txCount += len(blk.getTransactions())
+                if seen % chunkSize == 0:
+                    self._flushStoreQueue()
+                    elapsed = time.time() - began
+                    logger.info("Imported %d/%d blocks, %.1f blocks/s, %.1f txs/s" %
+                                (connected, seen, connected / elapsed, txCount / elapsed))
+            self._flushStoreQueue()
+        finally:
+            self._storeQueue = None
+            if pool is not None:
+                pool.terminate()
+                pool.join()
+
+        elapsed = max(time.time() - began, 1e-9)
+        logger.info("Imported %d/%d blocks and %d transactions in %.1fs, %.1f blocks/s, %.1f txs/s" %
+                    (connected, seen, txCount, elapsed, connected / elapsed, txCount / elapsed))
+        return connected
+
+    def _flushStoreQueue(self):
+        # Under the lock so getBlock never misses a final block still queued
+        with self._lock:
+            if self._storeQueue:
+                storeBlocks(self._db, self._storeQueue)
+                self._storeQueue = []
+
+    def reorganize(self, blkHash: bytes):
+        """
+        Makes blkHash the latest block. The UTXO set is rolled back with the
+        undo data of the blocks above the fork point and rolled forward along
+        the new branch, so the cost depends on the depth of the reorganization
+        only. Transactions of the disconnected blocks that the new branch does
+        not include go back to the transaction pool, while the transactions
+        of connected blocks and their conflicts leave it.
+        """
+        disconnect, connect = self._state.UpdateLatestView(blkHash)
+        confirmed = set()
+        for view in connect:
+            self._txPool.removeForBlock(view.blk.getTransactions())
+            for tx in view.blk.getTransactions():
+                confirmed.add(tx.hash)
+        if len(disconnect) != 0:
+            # Oldest block first so parents are back before their children
+            returned = []
+            for view in reversed(disconnect):
+                for tx in view.blk.getTransactions():
+                    if tx.hash not in confirmed:
+                        returned.append(tx)
+            for tx in returned:
+                self.addTransaction(tx)
+            # Outputs of the disconnected blocks, coinbases included, are gone,
+            # checked once the returned transactions can fund pooled children
+            self._txPool.removeUnspendable(self._state.utxos)
+            logger.info("Reorganized %d blocks off and %d blocks on, %d transactions back to the pool" %
+                        (len(disconnect), len(connect), len(returned)))
+        for listener in self._tipListeners:
+            listener(self._state.latestView)
+
+    def addTransaction(self, tx: Transaction, now: float = None):
         #IMPLEMENT THIS
         #---SOLUTION---
-        self._txPool.addTransaction(tx)
-        return
-        #---SOLUTION---
\ No newline at end of file
+        with self._lock:
+            # Checked once at the door, against the latest UTXO set with the pool
+            # applied, and the pool entry remembers it
+            view = MempoolUTXOView(self._state.utxos, self._txPool)
+            if not TxHandler(view, None, self._admissionStats).isValidTx(tx):
+                return False
+            return self._txPool.addTransaction(tx, self.getFee(tx), now, validated=True)
+        #---SOLUTION---
+
+    def saveMempool(self, path: str = None) -> int:
+        with self._lock:
+            path = path or settings.MEMPOOL_FILE
+            began = time.time()
+            count = self._txPool.dump(path)
+            logger.info("Saved %d pooled transactions to %s in %.1fs" % (count, path, time.time() - began))
+            return count
+
+    def loadMempool(self, path: str = None, batchSize: int = None) -> int:
+        """
+        Streams a dump of saveMempool back through admission. The signatures
+        of each batch are checked in one go by the verifier, the transactions
+        are then admitted one by one and only hit the signature cache.
+        Expired entries are skipped.
+        :return: <int> number of transactions admitted
+        """
+        path = path or settings.MEMPOOL_FILE
+        batchSize = batchSize or settings.MEMPOOL_LOAD_BATCH
+        began = time.time()
+        read = 0
+        admitted = 0
+        batch = []
+        for tx, arrival in TransactionPool.readDump(path):
+            read += 1
+            if began - arrival >= self._txPool.expiry:
+                continue
+            batch.append((tx, arrival))
+            if len(batch) == batchSize:
+                admitted += self._admitBatch(batch)
+                batch = []
+        admitted += self._admitBatch(batch)
+        elapsed = time.time() - began
+        logger.info("Loaded %d of %d pooled transactions from %s in %.1fs, %.0f txs/s" %
+                    (admitted, read, path, elapsed, read / elapsed if elapsed > 0 else 0))
+        return admitted
+
+    def _admitBatch(self, batch) -> int:
+        if not batch:
+            return 0
+        if self._verifier is not None:
+            view = MempoolUTXOView(self._state.utxos, self._txPool)
+            TxHandler(view, self._verifier).prefetchSignatures([tx for (tx, _) in batch])
+        admitted = 0
+        for (tx, arrival) in batch:
+            if self.addTransaction(tx, arrival):
+                admitted += 1
+        return admitted
+
+    def getFee(self, tx: Transaction):
+        # Inputs minus outputs, inputs from the latest UTXO set or pooled
+        # transactions; None if one is unknown or the outputs exceed them
+        utxos = self._state.utxos
+        fee = decimal.Decimal()
+        for inp in tx.inputs:
+            utxo = UTXO(inp.prevTxHash, inp.outputIndex)
+            output = utxos.getTxOutput(utxo)
+            if output is None:
+                output = self._txPool.getTxOutput(utxo)
+            if output is None:
+                return None
+            fee += output.value
+        for out in tx.outputs:
+            fee -= out.value
+        return fee if fee >= 0 else None
\ No newline at end of file
@@ -1,3 +1,10 @@
+import atexit
+import os
+import struct
+import threading
+import time
+
+from fullchain.core.blocktemplate import BlockTemplate
 from fullchain.core.txhandler import TxHandler
 from fullchain.core.transaction import Transaction 
 from fullchain.core.block import Block
@@ -6,19 +13,44 @@ from fullchain.core.pow import *
 from fullchain.storage.leveldb.leveldbimpl import *
 from Cryptodome.PublicKey import RSA
 from fullchain.core.account import *
+# leveldbimpl exports the storage settings as settings, these are the node's
+from fullchain.core import settings as coreSettings
+from fullchain.logs.logging import log_manager
 
+logger = log_manager.getLogger()
 
 
 class BlockHandler:
     def __init__(
         self,
         privateKey: RSA.RsaKey,
+        minerWorkers: int = None,
     ):
         genesisBlk = self.getGenesisBlock()
         self.database = LevelDBImpl()
         print(genesisBlk.getHash())
-        self._blockchain = BlockChain(genesisBlk)
+        self._blockchain = BlockChain(genesisBlk, db=self.database)
         self._privateKey = privateKey
+        self._pow = ParallelPow(minerWorkers)
+        self._template = BlockTemplate(self._blockchain, privateKey.public_key())
+        # The pool survives restarts: loaded in the background while mining
+        # starts, saved periodically and on exit once the load is over
+        self._mempoolLoaded = threading.Event()
+        self._mempoolSaved = time.time()
+        threading.Thread(target=self._loadMempool, daemon=True).start()
+        atexit.register(self.saveMempool)
+
+    @property
+    def pow(self):
+        return self._pow
+
+    @property
+    def blockchain(self):
+        return self._blockchain
+
+    @property
+    def template(self):
+        return self._template
 
     def validateBlock(self, block: Block):
         if block is None:
@@ -26,8 +58,8 @@ class BlockHandler:
         parent = self._blockchain.state.GetViewByHash(block._prevBlockHash)
         if parent is None:
             return False
-        utxsPool = parent._utxos
-        ok = validate_proof_of_work(parent._blk.nonce, parent._blk.getHash(), block._nonce, BlockChain.DIFFICULTY)
+        utxsPool = parent.utxos
+        ok = validate_proof_of_work(parent._blk.getNonce(), parent._blk.getHash(), block._nonce, BlockChain.DIFFICULTY)
         if ok == True:
             handler = TxHandler(utxsPool)
             validTxs = handler.handleTxs(block.getTransactions())
@@ -36,34 +68,51 @@ class BlockHandler:
         return False
 
     def createBlock(self, difficulty):
-        selfAddress = self._privateKey.public_key()
+        """
+        Searches a nonce on the latest block, then takes the block template
+        as it is at that moment. Returns None if the tip changed meanwhile.
+        """
+        if time.time() - self._mempoolSaved >= coreSettings.MEMPOOL_SAVE_INTERVAL:
+            self.saveMempool()
+        self._template.tipChanged.clear()
         parent = self._blockchain.getMaxHeightBlock()
-        prevHash = parent._hash
-        utxoPool = self._blockchain.getMaxHeightUTXOPool()
-        txsPool = self._blockchain.getTransactionPool()
-        txs = txsPool.getTransactions()
-        handler = TxHandler(utxoPool)
-        validTxs = handler.handleTxs(txs)
-        
-        current = Block(
-            prevHash,
-            selfAddress,
-            validTxs,
-            parent._height + 1,
-            None,
-            parent._nonce
-        )
-        nonce = generate_proof_of_work(parent, BlockChain.DIFFICULTY)
+        nonce = generate_proof_of_work(parent, difficulty, self._pow, self._template.tipChanged)
+        if nonce is None:
+            return None
+        current = self._template.getBlock()
+        if current._prevBlockHash != parent._hash:
+            return None
         current._nonce = nonce
         current.finalize()
         if self._blockchain.addBlock(current):
             return current
+        self._template.reject(current)
         return None
 
+    def _loadMempool(self):
+        path = coreSettings.MEMPOOL_FILE
+        try:
+            if os.path.exists(path):
+                self._blockchain.loadMempool(path)
+        except (OSError, EOFError, ValueError, struct.error) as e:
+            # A bad file must not stop the node, it is kept aside for a look
+            logger.error("Could not load the transaction pool from %s, moved to %s.bad: %s" % (path, path, e))
+            os.replace(path, path + '.bad')
+        finally:
+            self._mempoolLoaded.set()
+
+    def saveMempool(self):
+        # Saving a partly loaded pool would lose the rest of the file
+        if not self._mempoolLoaded.is_set():
+            return
+        self._mempoolSaved = time.time()
+        self._blockchain.saveMempool(coreSettings.MEMPOOL_FILE)
+
     def processTx(self, tx: Transaction):
-        self._blockchain.addTransaction(tx)
+        return self._blockchain.addTransaction(tx)
 
-    def getGenesisBlock(self):
+    @staticmethod
+    def getGenesisBlock():
         md = hashlib.sha256()
         md.update(b'\x00')
         prevHash = md.digest()
@@ -0,0 +1,179 @@
+import heapq
+import itertools
+
+
+def _invertLowestOne(n: int) -> int:
+    return n & (n - 1)
+
+
+def getSkipHeight(height: int) -> int:
+    # Height the skip pointer of a block at `height` jumps to. Any height is
+    # reached from any descendant in O(log n) jumps, as in Bitcoin Core
+    if height < 2:
+        return 0
+    if height & 1:
+        return _invertLowestOne(_invertLowestOne(height - 1)) + 1
+    return _invertLowestOne(height)
+
+
+class BlockIndexEntry:
+    """
+    Node of the block tree: links to the parent and children, a skip pointer
+    to a far ancestor, height, work of the chain ending here, validation
+    status and the BlockHeader, which the proof of work of children needs.
+    """
+    # Status flags
+    HAVE_HEADER = 1   # header known, proof of work checked
+    HAVE_DATA = 2     # transactions validated and connected to the parent view
+    FAILED = 4        # the block or one of its ancestors is invalid
+
+    __slots__ = ('hash', 'prevHash', 'parent', 'skip', 'children', 'height', 'chainWork', 'status', 'sequence',
+                 'header')
+
+    def __init__(self, blkHash: bytes, prevHash: bytes, parent, height: int, work: int, status: int, sequence: int,
+                 header=None):
+        self.hash = blkHash
+        self.prevHash = prevHash
+        self.parent = parent
+        self.skip = None if parent is None else parent.getAncestor(getSkipHeight(height))
+        self.children = []
+        self.height = height
+        self.chainWork = work if parent is None else parent.chainWork + work
+        self.status = status
+        self.sequence = sequence
+        self.header = header
+
+    def isValid(self, status: int = HAVE_DATA) -> bool:
+        return self.status & status == status and not self.status & BlockIndexEntry.FAILED
+
+    def getAncestor(self, height: int):
+        # Ancestor at `height` in O(log n), None if it is not in the index
+        if height > self.height or height < 0:
+            return None
+        walk = self
+        heightWalk = self.height
+        while heightWalk > height:
+            heightSkip = getSkipHeight(heightWalk)
+            heightSkipPrev = getSkipHeight(heightWalk - 1)
+            if walk.skip is not None and (heightSkip == height or (
+                    heightSkip > height and not (heightSkipPrev < heightSkip - 2 and heightSkipPrev >= height))):
+                walk = walk.skip
+                heightWalk = heightSkip
+            else:
+                walk = walk.parent
+                heightWalk -= 1
+            if walk is None:
+                return None
+        return walk
+
+
+def lastCommonAncestor(a: BlockIndexEntry, b: BlockIndexEntry):
+    # Fork point of the branches ending at a and b, None if they share no root
+    if a.height > b.height:
+        a = a.getAncestor(b.height)
+    elif b.height > a.height:
+        b = b.getAncestor(a.height)
+    while a is not b and a is not None and b is not None:
+        if a.skip is not None and b.skip is not None and a.skip is not b.skip:
+            a = a.skip
+            b = b.skip
+        else:
+            a = a.parent
+            b = b.parent
+    return a if a is b else None
+
+
+class BlockIndex:
+    """
+    Every known block as a tree, with the valid tip of most cumulative work
+    kept at the top of a heap. Ties go to the block seen first. Entries that
+    lost their validity stay in the heap and are skipped lazily, so adding a
+    block and reading the best tip are O(log n). A second heap does the same
+    for headers whose block data may still be missing.
+    """
+
+    def __init__(self):
+        self._entries = dict()
+        self._candidates = []
+        self._headerCandidates = []
+        self._sequence = itertools.count()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, blkHash: bytes):
+        return blkHash in self._entries
+
+    def get(self, blkHash: bytes) -> BlockIndexEntry:
+        return self._entries.get(blkHash)
+
+    def addEntry(self, blkHash: bytes, prevHash: bytes, height: int, work: int, status: int,
+                 header=None) -> BlockIndexEntry:
+        entry = self._entries.get(blkHash)
+        if entry is not None:
+            if entry.header is None:
+                entry.header = header
+            self.raiseStatus(entry, status)
+            return entry
+        parent = self._entries.get(prevHash)
+        entry = BlockIndexEntry(blkHash, prevHash, parent, height, work, status, next(self._sequence), header)
+        if parent is not None:
+            parent.children.append(entry)
+        self._entries[blkHash] = entry
+        self._push(entry)
+        return entry
+
+    def raiseStatus(self, entry: BlockIndexEntry, status: int):
+        if entry.status & status != status:
+            hadHeader = entry.isValid(BlockIndexEntry.HAVE_HEADER)
+            entry.status |= status
+            self._push(entry, not hadHeader)
+
+    def invalidate(self, entry: BlockIndexEntry):
+        # Marks entry and all of its descendants as failed
+        stack = [entry]
+        while stack:
+            node = stack.pop()
+            node.status |= BlockIndexEntry.FAILED
+            stack.extend(node.children)
+
+    def remove(self, entry: BlockIndexEntry):
+        # Removes entry alone, its children become roots
+        self._entries.pop(entry.hash, None)
+        if entry.parent is not None and entry in entry.parent.children:
+            entry.parent.children.remove(entry)
+        for child in entry.children:
+            child.parent = None
+        # Entries still pointing here do not keep the rest of the chain alive
+        entry.parent = None
+        entry.skip = None
+        entry.children = []
+        entry.status |= BlockIndexEntry.FAILED
+        if len(self._candidates) > 2 * len(self._entries) + 16:
+            self._candidates = [c for c in self._candidates if c[2].isValid()]
+            heapq.heapify(self._candidates)
+        if len(self._headerCandidates) > 2 * len(self._entries) + 16:
+            self._headerCandidates = [c for c in self._headerCandidates
+                                      if c[2].isValid(BlockIndexEntry.HAVE_HEADER)]
+            heapq.heapify(self._headerCandidates)
+
+    def _push(self, entry: BlockIndexEntry, newHeader: bool = True):
+        if entry.isValid():
+            heapq.heappush(self._candidates, (-entry.chainWork, entry.sequence, entry))
+        if newHeader and entry.isValid(BlockIndexEntry.HAVE_HEADER):
+            heapq.heappush(self._headerCandidates, (-entry.chainWork, entry.sequence, entry))
+
+    @staticmethod
+    def _top(candidates, status):
+        while candidates and not candidates[0][2].isValid(status):
+            heapq.heappop(candidates)
+        if not candidates:
+            return None
+        return candidates[0][2]
+
+    def getBest(self) -> BlockIndexEntry:
+        return BlockIndex._top(self._candidates, BlockIndexEntry.HAVE_DATA)
+
+    def getBestHeader(self) -> BlockIndexEntry:
+        # Tip of the most work header chain, its blocks may not be downloaded yet
+        return BlockIndex._top(self._headerCandidates, BlockIndexEntry.HAVE_HEADER)
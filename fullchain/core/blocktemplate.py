@@ -0,0 +1,133 @@
+import threading
+
+from fullchain.core.block import Block
+from fullchain.core.blockassembler import BlockAssembler
+from fullchain.core.transactionpool import MempoolUTXOView
+from fullchain.core.txhandler import TxHandler
+from fullchain.logs.logging import log_manager
+
+logger = log_manager.getLogger()
+
+
+class BlockTemplate:
+    """
+    The block the miner takes once its nonce is found, kept up to date while
+    the nonce is searched. A transaction entering the pool is appended to the
+    template when its pooled parents already are in it and it fits, a
+    transaction leaving the pool or a new tip marks the template dirty and
+    the next getBlock rebuilds it with the BlockAssembler. Nothing is validated again: pool entries were validated
+    on admission, only those added to the pool directly are checked here,
+    once.
+
+    Pool changes happen under the chain lock, the template takes it as well
+    whenever it reads or changes the pool itself.
+
+    The proof of work covers the parent nonce and hash only, so a nonce
+    search is stale on a new tip only: `tipChanged` is set then, transaction
+    changes just show up in the block taken once the nonce is found.
+    """
+
+    def __init__(self, blockchain, address, maxBytes: int = None):
+        self._blockchain = blockchain
+        self._pool = blockchain.getTransactionPool()
+        self._assembler = BlockAssembler(self._pool, maxBytes)
+        self._maxBytes = self._assembler.maxBytes
+        self._address = address
+        self._block = None
+        self._txHashes = set()
+        self._bytes = 0
+        self._lock = threading.RLock()
+        self.tipChanged = threading.Event()
+        self._pool.addListener(self._onPoolChange)
+        blockchain.addTipListener(self._onTipChange)
+
+    def _onTipChange(self, latestView):
+        with self._lock:
+            self._block = None
+        self.tipChanged.set()
+
+    def _onPoolChange(self, added, removed):
+        with self._lock:
+            if self._block is None:
+                return
+            for tx in removed:
+                if tx.hash in self._txHashes:
+                    self._block = None
+                    return
+            for tx in added:
+                self._append(tx)
+
+    def _append(self, tx):
+        # Called with the lock held on a built template
+        size = self._pool.getEntry(tx.hash).size
+        parents = self._pool.getParents(tx)
+        if self._bytes + size > self._maxBytes or not parents <= self._txHashes or not self._check(tx):
+            # Left to the next rebuild, which weighs it against the others
+            self._block = None
+            return
+        self._block.addTransaction(tx)
+        self._txHashes.add(tx.hash)
+        self._bytes += size
+
+    def _check(self, tx) -> bool:
+        # Full admission checks for entries added to the pool directly, against
+        # the latest block and the pool without tx's own spends
+        entry = self._pool.getEntry(tx.hash)
+        if entry.validated:
+            return True
+        view = MempoolUTXOView(self._blockchain.getMaxHeightUTXOPool(), self._pool, tx.hash)
+        if not TxHandler(view).isValidTx(tx):
+            return False
+        entry.validated = True
+        return True
+
+    def _rebuild(self):
+        parent = self._blockchain.getMaxHeightBlock()
+        while True:
+            txs = self._assembler.assemble(self._maxBytes)
+            invalid = [tx for tx in txs if not self._check(tx)]
+            if not invalid:
+                break
+            for tx in invalid:
+                logger.warning("Dropping invalid transaction %s from the pool" % tx.hash.hex())
+                self._pool.removeWithDescendants(tx.hash)
+        self._block = Block(parent._hash, self._address, txs, parent._height + 1, None, 0)
+        self._txHashes = set(tx.hash for tx in txs)
+        self._bytes = sum(self._pool.getEntry(tx.hash).size for tx in txs)
+
+    def getBlock(self) -> Block:
+        """
+        The up to date template, rebuilt only if a change since the last
+        call could not be applied in place. The block is handed over to the
+        caller, who sets its nonce, finalizes and adds it: the template lets
+        go of it, so later pool changes can not alter a block already hashed,
+        and the next call builds a new one.
+        """
+        # The chain lock first, as pool changes come with it held
+        with self._blockchain.lock, self._lock:
+            if self._block is None:
+                self._rebuild()
+            blk = self._block
+            self._block = None
+            return blk
+
+    def invalidate(self):
+        with self._lock:
+            self._block = None
+
+    def reject(self, blk: Block):
+        """
+        Called when the chain refused blk: its transactions that fail against
+        the parent leave the pool with their descendants, so the next
+        template does not repeat them, and the template is rebuilt.
+        """
+        with self._blockchain.lock, self._lock:
+            parent = self._blockchain.state.GetViewByHash(blk.getPrevBlockHash())
+            if parent is not None:
+                txs = blk.getTransactions()
+                valid = set(tx.hash for tx in TxHandler(parent.utxos).handleTxs(txs))
+                for tx in txs:
+                    if tx.hash not in valid and tx.hash in self._pool:
+                        logger.warning("Dropping transaction %s rejected with the block" % tx.hash.hex())
+                        self._pool.removeWithDescendants(tx.hash)
+            self._block = None
@@ -1,7 +1,78 @@
+import hashlib
+import multiprocessing
+import threading
+from collections import OrderedDict
+
 from Cryptodome.Hash import SHA256
 from Cryptodome.PublicKey import RSA
 from Cryptodome.Signature import pkcs1_15
 
+from fullchain.core import settings
+
+
+class SignatureCache:
+
+    """
+    Bounded LRU set of (signature hash, public key, signature) triples that
+    were verified successfully. A transaction checked when it entered the
+    mempool is then not checked again when the block including it is built or
+    connected. Only successes are remembered, so invalid signatures can not
+    push valid ones out.
+    """
+
+    # Approximate memory held by one entry: a 32 byte key in an OrderedDict
+    ENTRY_SIZE = 160
+
+    def __init__(self, maxBytes: int):
+        self._maxEntries = max(maxBytes // SignatureCache.ENTRY_SIZE, 0)
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key: bytes):
+        # Lookup that leaves the counters and the LRU order alone
+        return key in self._entries
+
+    @staticmethod
+    def makeKey(pubkey: RSA.RsaKey, message: bytes, signature: bytes) -> bytes:
+        md = hashlib.sha256()
+        md.update(hashlib.sha256(message).digest())
+        # n and e are length prefixed so no two keys give the same bytes
+        for value in (pubkey.n, pubkey.e):
+            length = (value.bit_length() + 7) // 8
+            md.update(length.to_bytes(4, 'big'))
+            md.update(value.to_bytes(length, 'big'))
+        md.update(signature)
+        return md.digest()
+
+    def contains(self, key: bytes) -> bool:
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return True
+            self.misses += 1
+            return False
+
+    def add(self, key: bytes):
+        with self._lock:
+            if self._maxEntries == 0:
+                return
+            self._entries[key] = None
+            self._entries.move_to_end(key)
+            while len(self._entries) > self._maxEntries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
 
 class Crypto:
 
@@ -9,10 +80,23 @@ class Crypto:
     @return true is {@code signature} is a valid digital signature of {@code message} under the
             key {@code pubKey}. Internally, this uses RSA signature, but the student does not
             have to deal with any of the implementation details of the specific signature
-            algorithm
+            algorithm. Successful checks are remembered in {@code Crypto.sigCache}.
     """
+
+    sigCache = SignatureCache(settings.SIG_CACHE_BYTES)
+
     @staticmethod
     def verifySignature(pubkey: RSA.RsaKey, message: bytes, signature: bytes):
+        key = SignatureCache.makeKey(pubkey, message, signature)
+        if Crypto.sigCache.contains(key):
+            return True
+        if not Crypto.verifySignatureUncached(pubkey, message, signature):
+            return False
+        Crypto.sigCache.add(key)
+        return True
+
+    @staticmethod
+    def verifySignatureUncached(pubkey: RSA.RsaKey, message: bytes, signature: bytes):
         h = SHA256.new(message)
         verifier = pkcs1_15.new(pubkey)
         try:
@@ -20,3 +104,61 @@ class Crypto:
             return True
         except (ValueError, TypeError):
             return False
+
+
+def _verifyJob(job):
+    # RsaKey objects can not be pickled, workers get the (n, e) pair
+    n, e, message, signature = job
+    return Crypto.verifySignatureUncached(RSA.construct((n, e)), message, signature)
+
+
+class BatchVerifier:
+
+    """
+    Checks many signatures at once over a process pool, used to validate full
+    blocks during sync. Valid signatures are recorded in Crypto.sigCache, so
+    the sequential validation that follows only looks them up. The pool is
+    created on first use and kept until close().
+    """
+
+    # Below this many uncached signatures the pool overhead is not worth it
+    MIN_BATCH = 16
+
+    def __init__(self, workers: int = None):
+        if not workers:
+            workers = settings.VERIFY_WORKERS or multiprocessing.cpu_count()
+        self._workers = workers
+        self._pool = None
+
+    @property
+    def workers(self):
+        return self._workers
+
+    def verify(self, jobs):
+        """
+        :param jobs: list of (public key, message, signature)
+        :return: list of bool, whether each signature is valid
+        """
+        keys = [SignatureCache.makeKey(*job) for job in jobs]
+        results = [key in Crypto.sigCache for key in keys]
+        pending = [i for i, cached in enumerate(results) if not cached]
+        if self._workers <= 1 or len(pending) < BatchVerifier.MIN_BATCH:
+            for i in pending:
+                results[i] = Crypto.verifySignature(*jobs[i])
+            return results
+
+        if self._pool is None:
+            self._pool = multiprocessing.Pool(self._workers)
+        args = [(jobs[i][0].n, jobs[i][0].e, jobs[i][1], jobs[i][2]) for i in pending]
+        chunksize = max(1, len(args) // (self._workers * 4))
+        for i, ok in zip(pending, self._pool.map(_verifyJob, args, chunksize)):
+            results[i] = ok
+            if ok:
+                Crypto.sigCache.add(keys[i])
+        return results
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.terminate()
+            self._pool.join()
+            self._pool = None
@@ -0,0 +1,115 @@
+import hashlib
+
+# Domain separation between leaves and inner nodes, as in RFC 6962, so an
+# inner node can never be passed off as a transaction.
+LEAF_PREFIX = b'\x00'
+NODE_PREFIX = b'\x01'
+
+
+def hashLeaf(data: bytes) -> bytes:
+    return hashlib.sha256(LEAF_PREFIX + data).digest()
+
+
+def hashChildren(left: bytes, right: bytes) -> bytes:
+    return hashlib.sha256(NODE_PREFIX + left + right).digest()
+
+
+def _splitPoint(n: int) -> int:
+    # Largest power of two strictly smaller than n, for n >= 2
+    return 1 << ((n - 1).bit_length() - 1)
+
+
+class MerkleTree:
+    """
+    Append-only Merkle tree with the shape of RFC 6962: the left subtree of a
+    node always holds the largest power of two leaves that is smaller than the
+    node size. _levels[h] keeps the roots of the complete subtrees of 2 ** h
+    leaves from left to right, so appending a leaf touches O(1) nodes amortized
+    and any subtree root or inclusion proof is read off in O(log n).
+    """
+
+    def __init__(self, leaves=None):
+        self._levels = [[]]
+        self._root = None
+        if leaves is not None:
+            for data in leaves:
+                self.append(data)
+
+    def __len__(self):
+        return len(self._levels[0])
+
+    def append(self, data: bytes):
+        node = hashLeaf(data)
+        height = 0
+        while True:
+            level = self._levels[height]
+            level.append(node)
+            if len(level) % 2 == 1:
+                break
+            node = hashChildren(level[-2], level[-1])
+            height += 1
+            if height == len(self._levels):
+                self._levels.append([])
+        self._root = None
+
+    def getLeaf(self, index: int) -> bytes:
+        return self._levels[0][index]
+
+    def getRoot(self) -> bytes:
+        if self._root is None:
+            if len(self) == 0:
+                self._root = hashlib.sha256(b"").digest()
+            else:
+                self._root = self._rangeRoot(0, len(self))
+        return self._root
+
+    def _rangeRoot(self, start: int, end: int) -> bytes:
+        size = end - start
+        height = size.bit_length() - 1
+        if size == 1 << height and start % size == 0:
+            return self._levels[height][start >> height]
+        k = _splitPoint(size)
+        return hashChildren(self._rangeRoot(start, start + k), self._rangeRoot(start + k, end))
+
+    def getProof(self, index: int) -> list:
+        """
+        Sibling hashes from the leaf at `index` up to the root, see verifyProof.
+        """
+        if not 0 <= index < len(self):
+            raise IndexError("Leaf index out of range")
+        proof = []
+        start, end = 0, len(self)
+        while end - start > 1:
+            k = _splitPoint(end - start)
+            if index < start + k:
+                proof.append(self._rangeRoot(start + k, end))
+                end = start + k
+            else:
+                proof.append(self._rangeRoot(start, start + k))
+                start = start + k
+        proof.reverse()
+        return proof
+
+    @staticmethod
+    def verifyProof(data: bytes, index: int, size: int, proof: list, root: bytes) -> bool:
+        """
+        Checks that `data` is the leaf at `index` of a tree of `size` leaves with
+        the given root, following RFC 9162 section 2.1.3.2.
+        """
+        if not 0 <= index < size:
+            return False
+        fn, sn = index, size - 1
+        node = hashLeaf(data)
+        for sibling in proof:
+            if sn == 0:
+                return False
+            if fn & 1 or fn == sn:
+                node = hashChildren(sibling, node)
+                while not fn & 1 and fn != 0:
+                    fn >>= 1
+                    sn >>= 1
+            else:
+                node = hashChildren(node, sibling)
+            fn >>= 1
+            sn >>= 1
+        return sn == 0 and node == root
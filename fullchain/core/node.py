@@ -1,9 +1,9 @@
-import multiprocessing
+import threading
 from fullchain.core.rpc import *
-from fullchain.storage.leveldb.leveldbimpl import *
+from fullchain.core.sync import HeaderSync
 
-def start_node(hostport='0.0.0.0:3009'):
-    init_node()
+def start_node(hostport='0.0.0.0:3009', blockchain=None):
+    init_node(blockchain)
     print('INFO', 'Node initialize success.')
     try:
         if hostport.find('.') != -1:
@@ -13,29 +13,19 @@ def start_node(hostport='0.0.0.0:3009'):
             port = hostport
     except Exception:
         print('ERROR','params must be {port} or {host}:{port} , ps: 3009 or 0.0.0.0:3009')
-    p = multiprocessing.Process(target=start_server,args=(host,int(port)))
+    # A thread, so get_headers and get_blocks answer from the live chain
+    p = threading.Thread(target=start_server,args=(host,int(port),blockchain),daemon=True)
     p.start()
     print('INFO','Node start success. Listen at %s.' % (hostport,))
 
-def init_node():
+def init_node(blockchain=None):
     """
-    Download blockchain from node compare with local database and select the longest blockchain.
+    Headers-first sync: fetch and check the headers of every node, select the
+    chain with most work and only then download the blocks of that chain.
     """
-    all_node_blockchains = BroadCast().get_blockchain()
-    all_node_txs = BroadCast().get_transactions()
-    bcdb = LevelDBImpl()
-    txdb = LevelDBImpl()
-    blockchain = bcdb.getBatch()
-    transactions = txdb.getBatch()
-    # If there is a blochain downloaded longer than local database then relace local's.
-    # for bc in all_node_blockchains:
-    #     if len(bc) > len(blockchain):
-    #         bcdb.write()
-            
-    # for txs in all_node_txs:
-    #     if len(txs) > len(transactions):
-    #         txdb.clear()
-    #         txdb.write(txs)    
+    if blockchain is None:
+        return
+    HeaderSync(blockchain).run()
 
     
 if __name__=='__main__':
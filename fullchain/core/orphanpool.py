@@ -0,0 +1,90 @@
+import time
+from collections import OrderedDict
+
+from fullchain.core import settings
+from fullchain.core.block import Block, BlockHeader
+
+
+class OrphanPool:
+    """
+    Blocks received before their parent, indexed by the hash of the missing
+    parent so they can be connected as soon as it arrives. The pool is bounded
+    in number of blocks and bytes, the oldest orphans are dropped first and
+    orphans older than `expiry` seconds are dropped on the next insertion.
+    """
+
+    def __init__(self, maxBlocks: int = None, maxBytes: int = None, expiry: int = None):
+        self._maxBlocks = maxBlocks if maxBlocks is not None else settings.MAX_ORPHAN_BLOCKS
+        self._maxBytes = maxBytes if maxBytes is not None else settings.MAX_ORPHAN_BYTES
+        self._expiry = expiry if expiry is not None else settings.ORPHAN_EXPIRY
+        # hash -> (block, size, arrival time), oldest first
+        self._byHash = OrderedDict()
+        self._byPrevHash = dict()
+        self._bytes = 0
+
+    def __len__(self):
+        return len(self._byHash)
+
+    @property
+    def bytes(self):
+        return self._bytes
+
+    def contains(self, blkHash: bytes):
+        return blkHash in self._byHash
+
+    @staticmethod
+    def getBlockSize(blk: Block) -> int:
+        size = BlockHeader.SIZE + len(blk.getCoinbase().getRawTx())
+        for tx in blk.getTransactions():
+            size += len(tx.getRawTx())
+        return size
+
+    def addBlock(self, blk: Block, now: float = None) -> bool:
+        blkHash = blk.getHash()
+        if blkHash in self._byHash:
+            return False
+        size = OrphanPool.getBlockSize(blk)
+        if size > self._maxBytes or self._maxBlocks == 0:
+            return False
+        if now is None:
+            now = time.time()
+        self.expire(now)
+        while len(self._byHash) >= self._maxBlocks or self._bytes + size > self._maxBytes:
+            self.removeBlock(next(iter(self._byHash)))
+        self._byHash[blkHash] = (blk, size, now)
+        self._byPrevHash.setdefault(blk.getPrevBlockHash(), set()).add(blkHash)
+        self._bytes += size
+        return True
+
+    def removeBlock(self, blkHash: bytes):
+        blk, size, _ = self._byHash.pop(blkHash)
+        siblings = self._byPrevHash[blk.getPrevBlockHash()]
+        siblings.discard(blkHash)
+        if len(siblings) == 0:
+            self._byPrevHash.pop(blk.getPrevBlockHash())
+        self._bytes -= size
+        return blk
+
+    def popChildren(self, prevHash: bytes):
+        # Removes and returns the orphans waiting for prevHash
+        return [self.removeBlock(blkHash) for blkHash in list(self._byPrevHash.get(prevHash, ()))]
+
+    def expire(self, now: float = None):
+        if now is None:
+            now = time.time()
+        while self._byHash:
+            blkHash, (_, _, arrival) = next(iter(self._byHash.items()))
+            if now - arrival < self._expiry:
+                break
+            self.removeBlock(blkHash)
+
+    def getMissingAncestor(self, blkHash: bytes):
+        # Hash of the block to download so that the orphan blkHash can connect
+        missing = blkHash
+        while missing in self._byHash:
+            missing = self._byHash[missing][0].getPrevBlockHash()
+        return missing
+
+    def getMissingParents(self):
+        # Hashes of the blocks to download so that every orphan can connect
+        return set(self.getMissingAncestor(blkHash) for blkHash in self._byHash)
@@ -1,4 +1,52 @@
 import hashlib
+import multiprocessing
+import queue
+import time
+
+from fullchain.core import settings
+from fullchain.logs.logging import log_manager
+
+logger = log_manager.getLogger()
+
+# Number of nonces a worker tries between two checks of the cancel flag.
+CHECK_INTERVAL = 4096
+
+def difficulty_to_target(difficulty):
+    """
+    A digest with `difficulty` leading zero hex digits is a 256 bit integer
+    below 2 ** (256 - 4 * difficulty)
+    :param difficulty: <int> Number of leading zero hex digits
+    :return: <int> Exclusive upper bound of a valid digest
+    """
+    return 1 << (256 - 4 * difficulty)
+
+def difficulty_to_work(difficulty):
+    """
+    :param difficulty: <int> Number of leading zero hex digits
+    :return: <int> Expected number of hashes to find a valid nonce
+    """
+    return 16 ** difficulty
+
+def proof_of_work_prefix(last_nonce, last_hash):
+    """
+    Hashes the part of the proof of work message shared by every nonce, callers
+    copy() the returned object instead of rehashing it for each attempt
+    :param last_nonce: <int> Nonce of the last block
+    :param last_hash: <str> Hash of the last block
+    :return: <hashlib.sha256> Midstate after the constant prefix
+    """
+    return hashlib.sha256(f'{last_nonce}{last_hash}'.encode())
+
+def check_nonce(prefix, nonce, target):
+    """
+    :param prefix: <hashlib.sha256> Midstate from proof_of_work_prefix
+    :param nonce: <int> Nonce to be checked
+    :param target: <int> Bound from difficulty_to_target
+    :return: <bool> True if correct, False if not.
+    """
+    sha = prefix.copy()
+    sha.update(str(nonce).encode())
+    return int.from_bytes(sha.digest(), 'big') < target
 
 def validate_proof_of_work(last_nonce, last_hash, nonce, difficulty):
     """
@@ -8,26 +56,135 @@ def validate_proof_of_work(last_nonce, last_hash, nonce, difficulty):
     :param last_hash: <str> Hash of the last block
     :return: <bool> True if correct, False if not.
     """
-    sha = hashlib.sha256(f'{last_nonce}{last_hash}{nonce}'.encode())
-    sha_str = sha.hexdigest()
-    for i in range(difficulty):
-        if sha_str[i] != '0':
-            return False
-    return True
+    prefix = proof_of_work_prefix(last_nonce, last_hash)
+    return check_nonce(prefix, nonce, difficulty_to_target(difficulty))
 
-def generate_proof_of_work(block, difficulty):
+def generate_proof_of_work(block, difficulty, engine=None, abort=None):
     """
     Very simple proof of work algorithm:
     - Find a number 'p' such that hash(pp') contains 4 leading zeroes
     - Where p is the previous proof, and p' is the new proof
     :param block: <Block> reference to the last block object
-    :return: <int> generated nonce
+    :param engine: <ParallelPow> optional process pool to spread the search over
+    :param abort: <threading.Event> optional, once set the search gives up
+    :return: <int> generated nonce, None if aborted
     """
     last_nonce = block._nonce
     last_hash = block._hash
 
+    if engine is not None:
+        return engine.search(last_nonce, last_hash, difficulty, abort)
+
+    prefix = proof_of_work_prefix(last_nonce, last_hash)
+    target = difficulty_to_target(difficulty)
     nonce = 0
-    while not validate_proof_of_work(last_nonce, last_hash, nonce, difficulty):
+    while not check_nonce(prefix, nonce, target):
         nonce += 1
+        if abort is not None and nonce % CHECK_INTERVAL == 0 and abort.is_set():
+            return None
+
+    return nonce
+
+
+_found = None
+
+def _init_worker(found):
+    global _found
+    _found = found
+
+def _search_nonces(last_nonce, last_hash, difficulty, start, step):
+    """
+    Worker side of ParallelPow, tries start, start + step, start + 2 * step, ...
+    until it finds a valid nonce or another worker raises the shared flag.
+    :return: <tuple> (worker, nonce or None, hashes tried, seconds spent)
+    """
+    prefix = proof_of_work_prefix(last_nonce, last_hash)
+    target = difficulty_to_target(difficulty)
+    began = time.time()
+    nonce = start
+    tried = 0
+    while True:
+        for _ in range(CHECK_INTERVAL):
+            tried += 1
+            if check_nonce(prefix, nonce, target):
+                _found.set()
+                return start, nonce, tried, time.time() - began
+            nonce += step
+        if _found.is_set():
+            return start, None, tried, time.time() - began
+
+
+class ParallelPow:
+    """
+    Splits the nonce space of generate_proof_of_work over a pool of processes.
+    Worker i tries the nonces congruent to i modulo the number of workers, the
+    first one to find a valid nonce raises a shared flag and the others stop.
+    The pool is kept alive between searches, call close() when done mining.
+    """
+
+    def __init__(self, workers: int = None):
+        if not workers:
+            workers = settings.MINER_WORKERS or multiprocessing.cpu_count()
+        self._workers = workers
+        self._found = multiprocessing.Event()
+        self._pool = None
+        self._hashrates = {}
+
+    @property
+    def workers(self):
+        return self._workers
+
+    @property
+    def hashrates(self):
+        # Hashes per second of each worker during the last search
+        return self._hashrates
+
+    def search(self, last_nonce, last_hash, difficulty, abort=None):
+        """
+        :param abort: <threading.Event> optional, once set the workers are
+        stopped and None is returned
+        :return: <int> nonce found, None if aborted
+        """
+        if self._pool is None:
+            self._pool = multiprocessing.Pool(self._workers, _init_worker, (self._found,))
+        self._found.clear()
+        results = queue.Queue()
+        for worker in range(self._workers):
+            self._pool.apply_async(
+                _search_nonces,
+                (last_nonce, last_hash, difficulty, worker, self._workers),
+                callback=results.put,
+                error_callback=results.put,
+            )
+
+        nonce = None
+        error = None
+        self._hashrates = {}
+        for _ in range(self._workers):
+            result = None
+            while result is None:
+                try:
+                    result = results.get(timeout=0.1)
+                except queue.Empty:
+                    if abort is not None and abort.is_set():
+                        self._found.set()
+            if isinstance(result, Exception):
+                self._found.set()
+                error = result
+                continue
+            worker, found, tried, elapsed = result
+            self._hashrates[worker] = tried / elapsed if elapsed > 0 else 0.0
+            if found is not None and nonce is None:
+                nonce = found
+        if error is not None:
+            raise error
+
+        logger.debug("Found nonce %s at %.0f H/s over %d workers" %
+                     (nonce, sum(self._hashrates.values()), self._workers))
+        return nonce
 
-    return nonce
\ No newline at end of file
+    def close(self):
+        if self._pool is not None:
+            self._pool.terminate()
+            self._pool.join()
+            self._pool = None
@@ -1,16 +1,42 @@
+import binascii
+import os
+import threading
+from socketserver import ThreadingMixIn
 from xmlrpc.server import SimpleXMLRPCServer  
-from xmlrpc.client import ServerProxy
-from node import get_nodes, add_node
+from xmlrpc.client import Binary, ServerProxy
+
+from fullchain.core import settings
 # from database import BlockChainDB, UnTransactionDB, TransactionDB
 # from lib.common import cprint
 server = None
 
 PORT = 8301
 
+# Most headers in a get_headers answer and blocks in a get_blocks answer
+MAX_HEADERS = 2000
+MAX_BLOCKS = 16
+
+# Addresses of the known nodes, as http://host:port. They are kept in
+# settings.NODES_FILE as `node add` runs in its own process
+_nodesLock = threading.Lock()
+
+def get_nodes():
+    if not os.path.exists(settings.NODES_FILE):
+        return []
+    with open(settings.NODES_FILE) as f:
+        return [line.strip() for line in f if line.strip()]
+
+def add_node(address):
+    with _nodesLock:
+        if address not in get_nodes():
+            with open(settings.NODES_FILE, 'a') as f:
+                f.write(address + '\n')
+
 class RpcServer():
 
-    def __init__(self,server):
+    def __init__(self,server,blockchain=None):
         self.server = server
+        self.blockchain = blockchain
 
     def ping(self):
         return True
@@ -28,6 +54,25 @@ class RpcServer():
         print('INFO',"Receive new block.")
         return "Receive new block."
 
+    def get_headers(self, locator, limit=MAX_HEADERS):
+        # Raw headers following the first [height, hash] of locator on our chain
+        if self.blockchain is None:
+            return []
+        locator = [(height, blkHash.data) for height, blkHash in locator]
+        return [Binary(raw) for raw in self.blockchain.getHeaders(locator, min(limit, MAX_HEADERS))]
+
+    def get_blocks(self, hashes):
+        # Serialized blocks in the order asked, up to the first unknown one
+        blocks = []
+        if self.blockchain is None:
+            return blocks
+        for blkHash in hashes[:MAX_BLOCKS]:
+            blk = self.blockchain.getBlock(blkHash.data)
+            if blk is None:
+                break
+            blocks.append(Binary(binascii.unhexlify(blk.toByteArray())))
+        return blocks
+
     def get_transactions(self):
         return "GetTransactions"
         # tdb = TransactionDB()
@@ -51,7 +96,7 @@ class RpcServer():
 
 class RpcClient():
 
-    ALLOW_METHOD = ['get_transactions', 'get_blockchain', 'new_block', 'new_untransaction', 'blocked_transactions', 'ping', 'add_node']
+    ALLOW_METHOD = ['get_transactions', 'get_blockchain', 'get_headers', 'get_blocks', 'new_block', 'new_untransaction', 'blocked_transactions', 'ping', 'add_node']
 
     def __init__(self, node):
         self.node = node
@@ -78,9 +123,13 @@ class BroadCast():
             return rs
         return noname
 
-def start_server(ip, port=8301):
-    server = SimpleXMLRPCServer((ip, port))
-    rpc = RpcServer(server)
+class ThreadingRpcServer(ThreadingMixIn, SimpleXMLRPCServer):
+    # One thread per request, so a peer can keep several downloads in flight
+    daemon_threads = True
+
+def start_server(ip, port=8301, blockchain=None):
+    server = ThreadingRpcServer((ip, port), logRequests=False)
+    rpc = RpcServer(server, blockchain)
     server.register_instance(rpc)
     server.serve_forever()
 
@@ -0,0 +1,64 @@
+from environs import Env
+
+env = Env()
+
+# Number of processes used to search for nonces, 0 means one per CPU core.
+MINER_WORKERS = env.int('MINER_WORKERS', default=0)
+
+# Memory budget of the cache of verified signatures, in bytes.
+SIG_CACHE_BYTES = env.int('SIG_CACHE_BYTES', default=32 * 1024 * 1024)
+
+# Number of processes used to check the signatures of a block in one batch,
+# 0 means one per CPU core and 1 checks them one by one.
+VERIFY_WORKERS = env.int('VERIFY_WORKERS', default=0)
+
+# Blocks deeper than this below the latest block are final: they are written
+# to the database and their views and competing branches leave memory.
+CUT_OFF_AGE = env.int('CUT_OFF_AGE', default=10)
+
+# Limits of the pool of blocks received before their parent.
+MAX_ORPHAN_BLOCKS = env.int('MAX_ORPHAN_BLOCKS', default=100)
+MAX_ORPHAN_BYTES = env.int('MAX_ORPHAN_BYTES', default=16 * 1024 * 1024)
+ORPHAN_EXPIRY = env.int('ORPHAN_EXPIRY', default=20 * 60)
+
+# Hex hash of a block whose ancestors are assumed to carry valid signatures:
+# they are connected with full UTXO and amount checks but no RSA work.
+# Empty checks every signature.
+ASSUME_VALID = env.str('ASSUME_VALID', default='')
+
+# Checkpoints of the main chain as height=hex hash pairs, e.g.
+# CHECKPOINTS=1000=ab12..,2000=cd34..: no block may fork below the highest
+# one the chain has reached. None ship, the genesis hash depends on the
+# deployment's genesis key.
+CHECKPOINTS = env.dict('CHECKPOINTS', subcast_keys=int, default={})
+
+# Bulk import: processes parsing blocks (0 means one per CPU core) and
+# number of blocks per database write batch.
+IMPORT_WORKERS = env.int('IMPORT_WORKERS', default=0)
+IMPORT_CHUNK_SIZE = env.int('IMPORT_CHUNK_SIZE', default=500)
+
+# Block download: blocks past the next one to connect that may be requested,
+# concurrent requests per peer, and seconds after which the oldest request is
+# given to another peer and the stalled one dropped.
+DOWNLOAD_WINDOW = env.int('DOWNLOAD_WINDOW', default=1024)
+DOWNLOAD_PEER_REQUESTS = env.int('DOWNLOAD_PEER_REQUESTS', default=2)
+DOWNLOAD_STALL_TIMEOUT = env.float('DOWNLOAD_STALL_TIMEOUT', default=10.0)
+
+# Limits of the pool of unconfirmed transactions: size in bytes, past which
+# the lowest fee rates are evicted, and age in seconds.
+MEMPOOL_MAX_BYTES = env.int('MEMPOOL_MAX_BYTES', default=64 * 1024 * 1024)
+MEMPOOL_EXPIRY = env.int('MEMPOOL_EXPIRY', default=14 * 24 * 60 * 60)
+
+# Most bytes of transactions the block assembler puts in a block template.
+MAX_BLOCK_BYTES = env.int('MAX_BLOCK_BYTES', default=1024 * 1024)
+
+# The transaction pool is saved to this file on shutdown and every
+# MEMPOOL_SAVE_INTERVAL seconds, and reloaded on startup in batches of
+# MEMPOOL_LOAD_BATCH transactions.
+MEMPOOL_FILE = env.str('MEMPOOL_FILE', default='mempool.dat')
+MEMPOOL_SAVE_INTERVAL = env.int('MEMPOOL_SAVE_INTERVAL', default=10 * 60)
+MEMPOOL_LOAD_BATCH = env.int('MEMPOOL_LOAD_BATCH', default=1000)
+
+# Addresses of the known nodes, one per line, shared by the command line and
+# the running node.
+NODES_FILE = env.str('NODES_FILE', default='nodes.txt')
@@ -1,4 +1,5 @@
 import multiprocessing
+import threading
 from fullchain.core.account import *
 from fullchain.core.rpc import *
 from transaction import *
@@ -22,7 +23,10 @@ class Node():
         print('Allnode',get_nodes())
     
     def run(self, args):
-        start_node(args[0])
+        # A node that does not mine still keeps and serves the chain
+        blockchain = BlockChain(BlockHandler.getGenesisBlock(), db=LevelDBImpl())
+        start_node(args[0], blockchain)
+        threading.Event().wait()
 
 
 
@@ -32,11 +36,16 @@ class Miner():
         if selfAcc is None:
             print('ERROR','Please create account before start miner.')
             exit()
-        start_node(args[0])
-        blkHandler = BlockHandler(selfAcc)
+        workers = int(args[1]) if len(args) > 1 else None
+        blkHandler = BlockHandler(selfAcc, workers)
+        start_node(args[0], blkHandler.blockchain)
         while True:
             newBlk = blkHandler.createBlock(BlockChain.DIFFICULTY)
+            if newBlk is None:
+                continue
             print('Miner new block', newBlk.getHash())
+            for worker, rate in sorted(blkHandler.pow.hashrates.items()):
+                print('INFO', 'Worker %d: %.0f H/s' % (worker, rate))
 
 
 
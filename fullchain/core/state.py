@@ -1,30 +1,96 @@
-from fullchain.core.utxo import UTXO, UTXOPool
+from fullchain.core.utxo import UTXO, UTXOPool, UTXOPoolView
 from fullchain.core.block import Block
+from fullchain.core.blockindex import BlockIndex, BlockIndexEntry, lastCommonAncestor
 
 def getUTXOPoolFromBlk(blk: Block):
     res = UTXOPool()
-    txs = blk.getTransactions()
-    txs.append(blk.getCoinbase())
-    for tx in blk._txs:
+    for tx in [blk.getCoinbase()] + blk.getTransactions():
         txHash = tx.hash
-        for idx, output in enumerate(blk._coinbase.outputs, start=1):
+        for idx, output in enumerate(tx.outputs):
             utxo = UTXO(txHash, idx)
             res.addUTXO(utxo,output)
     return res
-        
+
+class BlockUndo:
+    """
+    Changes a block made to the UTXO set of its parent: the (utxo, output)
+    pairs it created and the ones it spent. Replaying them in one direction or
+    the other moves a UTXO set across the block in O(block size).
+    """
+    def __init__(
+        self,
+        created: list = None,
+        spent: list = None,
+    ):
+        self._created = created if created is not None else []
+        self._spent = spent if spent is not None else []
+
+    @property
+    def created(self):
+        return self._created
+
+    @property
+    def spent(self):
+        return self._spent
+
+    @staticmethod
+    def FromUTXOPoolView(blk: Block, txsUTXOs: UTXOPoolView):
+        # txsUTXOs holds the changes made by the block transactions on top of
+        # the parent UTXO set, as left by TxHandler.handleTxs
+        parentUTXOs = txsUTXOs.base
+        spent = [(utxo, parentUTXOs.getTxOutput(utxo)) for utxo in txsUTXOs.removed]
+        created = list(txsUTXOs.added.items())
+        coinbase = blk.getCoinbase()
+        for idx, output in enumerate(coinbase.outputs):
+            created.append((UTXO(coinbase.hash, idx), output))
+        # An outpoint created again overwrites the parent's output, which has
+        # to come back when the block is disconnected
+        for utxo, _ in created:
+            if utxo not in txsUTXOs.removed and parentUTXOs.contains(utxo):
+                spent.append((utxo, parentUTXOs.getTxOutput(utxo)))
+        return BlockUndo(created, spent)
+
+    def connect(self, pool):
+        for utxo, _ in self._spent:
+            pool.removeUTXO(utxo)
+        for utxo, output in self._created:
+            pool.addUTXO(utxo, output)
+
+    def disconnect(self, pool):
+        for utxo, _ in self._created:
+            pool.removeUTXO(utxo)
+        for utxo, output in self._spent:
+            pool.addUTXO(utxo, output)
+
 class BlockChainState:
     class View:
         def __init__(
             self,
-            utxoPool: UTXOPool,
+            state,
             blk: Block,
+            undo: BlockUndo,
+            entry: BlockIndexEntry,
         ):
-            self._utxos = utxoPool
+            self._state = state
             self._blk = blk
-        
+            self._undo = undo
+            self._entry = entry
+
         @property 
         def utxos(self):
-            return self._utxos
+            return self._state.GetUTXOPool(self._blk._hash)
+
+        @property
+        def undo(self):
+            return self._undo
+
+        @property
+        def entry(self):
+            return self._entry
+
+        @property
+        def chainWork(self):
+            return self._entry.chainWork
 
         @property
         def height(self):
@@ -41,15 +107,19 @@ class BlockChainState:
     def __init__(
         self,
         genesisBlock: Block,
+        genesisWork: int = 1,
     ):
         self._viewByHash = dict()
-        self._blkHashByHeight = dict()
-        self._blkHashByPrevHash = dict()
-        blkUTXOs = getUTXOPoolFromBlk( genesisBlock)
-        view = BlockChainState.View(blkUTXOs, genesisBlock)
-        self._viewByHash[genesisBlock.getHash] = view
-        self._blkHashByHeight[genesisBlock._height] = [genesisBlock.getHash]
-        self._blkHashByPrevHash[genesisBlock._prevBlockHash] = [genesisBlock.getHash]
+        self._index = BlockIndex()
+        # The only materialized UTXO set, the one of _latestView. Other views
+        # only keep their BlockUndo and are rebuilt from it on demand
+        self._utxos = getUTXOPoolFromBlk(genesisBlock)
+        undo = BlockUndo([(utxo, self._utxos.getTxOutput(utxo)) for utxo in self._utxos.getAllUTXO()])
+        entry = self._index.addEntry(
+            genesisBlock.getHash(), genesisBlock._prevBlockHash, genesisBlock._height, genesisWork,
+            BlockIndexEntry.HAVE_HEADER | BlockIndexEntry.HAVE_DATA, genesisBlock.getHeader())
+        view = BlockChainState.View(self, genesisBlock, undo, entry)
+        self._viewByHash[genesisBlock.getHash()] = view
         self._latestView = view
         self._finalView = self._latestView
         
@@ -58,16 +128,15 @@ class BlockChainState:
     def AddView(
         self,
         newBlk: Block,
+        txsUTXOs: UTXOPoolView,
+        work: int = 1,
     ):
-        print(newBlk.getPrevBlockHash())
-        print(newBlk._hash)
-        blkUTXOs = getUTXOPoolFromBlk(newBlk)
-        prevView = self._viewByHash[newBlk._prevBlockHash]
-        viewUTXOPool = blkUTXOs._map.update(prevView._utxos._map)
-        view = BlockChainState.View(viewUTXOPool, newBlk)
+        undo = BlockUndo.FromUTXOPoolView(newBlk, txsUTXOs)
+        entry = self._index.addEntry(
+            newBlk._hash, newBlk._prevBlockHash, newBlk._height, work,
+            BlockIndexEntry.HAVE_HEADER | BlockIndexEntry.HAVE_DATA, newBlk.getHeader())
+        view = BlockChainState.View(self, newBlk, undo, entry)
         self._viewByHash[newBlk._hash] = view
-        self._blkHashByHeight[newBlk._height] = [newBlk._hash]
-        self._blkHashByPrevHash[newBlk._prevBlockHash] = [newBlk._hash]
         return view
 
     def DeleteBranch(
@@ -75,42 +144,113 @@ class BlockChainState:
         rootHeight: int,
         rootHash: bytes,
     ):
-        removedHashes = [rootHash]
-        removedHeight = rootHeight
-        while True:
-            tmp = removedHashes
-            removedHashes = []
-            for bhash in tmp:
-                self._blkHashByHeight[removedHeight].remove(bhash)
-                self._viewByHash.pop(bhash)
-                removedHashes += self._blkHashByPrevHash.get(bhash)
-                self._blkHashByPrevHash.pop(bhash)
-            if len(removedHashes)==0: 
-                break
-            removedHeight+=1
+        root = self._index.get(rootHash)
+        if root is None:
+            return
+        stack = [root]
+        while stack:
+            entry = stack.pop()
+            stack.extend(entry.children)
+            self._viewByHash.pop(entry.hash, None)
+            self._index.remove(entry)
 
     def UpdateFinalView(
         self,
         blkHash: bytes,
         blkHeight: int,
     ):
-        for bheight in range(self._finalView._height, blkHeight):
-            for bhash in self._blkHashByHeight.get(bheight):
-                self._viewByHash.pop(bhash)
-                self._blkHashByPrevHash.pop(bhash)
-            self._blkHashByHeight.pop(bheight)
-
-        for bhash in self._blkHashByHeight.get(blkHeight):
-            if bhash != blkHash:
-                self.DeleteBranch(blkHeight, bhash)
-        return
+        """
+        Makes blkHash, an ancestor of the latest view, the final view. Branches
+        forking off below it can never become the latest view again and are
+        deleted, views and index entries of its ancestors are evicted and it
+        becomes the root of the index. Returns the views that became final,
+        oldest first.
+        """
+        final = self._index.get(blkHash)
+        finalized = []
+        entry = final
+        while entry is not None and entry.height > self._finalView.height:
+            finalized.append(self._viewByHash[entry.hash])
+            entry = entry.parent
+        finalized.reverse()
+
+        child = final
+        entry = final.parent
+        while entry is not None:
+            for sibling in list(entry.children):
+                if sibling is not child:
+                    self.DeleteBranch(sibling.height, sibling.hash)
+            parent = entry.parent
+            self._viewByHash.pop(entry.hash, None)
+            self._index.remove(entry)
+            child = entry
+            entry = parent
+        self._finalView = self._viewByHash[blkHash]
+        return finalized
+
+    def FindPath(
+        self,
+        fromHash: bytes,
+        toHash: bytes,
+    ):
+        """
+        Views to disconnect walking back from fromHash to the fork point, and
+        views to connect from the fork point up to toHash, in that order.
+        """
+        src = self._index.get(fromHash)
+        dst = self._index.get(toHash)
+        fork = lastCommonAncestor(src, dst)
+        disconnect = []
+        connect = []
+        while src is not fork:
+            disconnect.append(self._viewByHash[src.hash])
+            src = src.parent
+        while dst is not fork:
+            connect.append(self._viewByHash[dst.hash])
+            dst = dst.parent
+        connect.reverse()
+        return disconnect, connect
+
+    def GetForkPoint(
+        self,
+        blkHash: bytes,
+        otherHash: bytes = None,
+    ):
+        # Last common ancestor of two blocks, by default of blkHash and the latest view
+        if otherHash is None:
+            otherHash = self._latestView.hash
+        a = self._index.get(blkHash)
+        b = self._index.get(otherHash)
+        if a is None or b is None:
+            return None
+        return lastCommonAncestor(a, b)
+
+    def GetUTXOPool(self, blkHash: bytes):
+        # The tip set itself, or an overlay on it rolled back to the fork
+        # point and forward along the branch of blkHash
+        if blkHash == self._latestView.hash:
+            return self._utxos
+        if blkHash not in self._viewByHash:
+            return None
+        disconnect, connect = self.FindPath(self._latestView.hash, blkHash)
+        pool = UTXOPoolView(self._utxos)
+        for view in disconnect:
+            view.undo.disconnect(pool)
+        for view in connect:
+            view.undo.connect(pool)
+        return pool
     
     def UpdateLatestView(
         self,
         blkHash: bytes,
     ):
+        disconnect, connect = self.FindPath(self._latestView.hash, blkHash)
+        for view in disconnect:
+            view.undo.disconnect(self._utxos)
+        for view in connect:
+            view.undo.connect(self._utxos)
         self._latestView = self._viewByHash[blkHash]
-        return 
+        return disconnect, connect
 
     @property
     def finalView(self):
@@ -120,5 +260,17 @@ class BlockChainState:
     def latestView(self):
         return self._latestView
 
+    @property
+    def utxos(self):
+        return self._utxos
+
+    @property
+    def index(self):
+        return self._index
+
+    def GetBestView(self):
+        # Valid view with the most cumulative work, first seen on ties
+        return self._viewByHash[self._index.getBest().hash]
+
     def GetViewByHash(self, blkHash: bytes):
         return self._viewByHash.get(blkHash)
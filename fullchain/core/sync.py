@@ -0,0 +1,256 @@
+import heapq
+import threading
+import time
+import xmlrpc.client
+
+from fullchain.core import settings
+from fullchain.core.rpc import MAX_BLOCKS, MAX_HEADERS, RpcClient, get_clients
+from fullchain.io.helper import Helper
+from fullchain.logs.logging import log_manager
+
+logger = log_manager.getLogger()
+
+
+def parseBlocks(hashes, raws):
+    """
+    Parses blocks a peer sent for hashes, None unless every block is there and
+    hashes to the header asked for, so a peer can not swap in other blocks.
+    """
+    if len(raws) != len(hashes):
+        return None
+    blocks = []
+    for blkHash, raw in zip(hashes, raws):
+        blk = Helper.AsSerializableWithType(raw, 'fullchain.core.block.Block')
+        if blk is None or blk.getHeader().getHash() != blkHash:
+            return None
+        blocks.append(blk)
+    return blocks
+
+
+class BlockDownloader:
+    """
+    Downloads blocks from several peers at once and yields them in height
+    order. The hashes are cut in batches of MAX_BLOCKS handed to whichever
+    peer is idle, only within DOWNLOAD_WINDOW blocks of the next one to yield,
+    and every peer runs DOWNLOAD_PEER_REQUESTS requests concurrently. Batches
+    arriving early wait in a reorder buffer. When the batch blocking the
+    window is older than DOWNLOAD_STALL_TIMEOUT, an idle peer takes it over
+    and the stalled peer is dropped, as is a peer that fails a request or
+    sends blocks that do not hash to the headers asked for.
+    """
+
+    def __init__(self, clients, hashes, window: int = None, peerRequests: int = None, stallTimeout: float = None):
+        self._clients = list(clients)
+        self._hashes = hashes
+        self._window = window or settings.DOWNLOAD_WINDOW
+        self._peerRequests = peerRequests or settings.DOWNLOAD_PEER_REQUESTS
+        self._stallTimeout = stallTimeout or settings.DOWNLOAD_STALL_TIMEOUT
+        self._cond = threading.Condition()
+        # Batch starts not requested yet, smallest first
+        self._pending = list(range(0, len(hashes), MAX_BLOCKS))
+        # start -> (node, time) of the requests running for that batch
+        self._inFlight = dict()
+        # Reorder buffer, start -> raw blocks
+        self._arrived = dict()
+        self._next = 0
+        self._closed = False
+        self._dropped = set()
+        self._workers = 0
+        self._received = dict()
+
+    @property
+    def dropped(self):
+        return self._dropped
+
+    @property
+    def received(self):
+        # Blocks used from each peer
+        return self._received
+
+    def _assign(self, node: str):
+        # Next batch for node, None when node has nothing more to do. Called with the lock held
+        while not self._closed and node not in self._dropped and self._next < len(self._hashes):
+            if self._pending and self._pending[0] < self._next + self._window:
+                start = heapq.heappop(self._pending)
+                self._inFlight.setdefault(start, []).append((node, time.time()))
+                return start
+            requests = self._inFlight.get(self._next, [])
+            if requests and all(other != node and time.time() - since > self._stallTimeout
+                                for (other, since) in requests):
+                for (other, since) in list(requests):
+                    logger.warning("Dropping %s, blocks at %d stalled" % (other, self._next))
+                    self._drop(other)
+                # Dropping put the batch back in the pending ones, node takes it instead
+                if self._next in self._pending:
+                    self._pending.remove(self._next)
+                    heapq.heapify(self._pending)
+                self._inFlight[self._next] = [(node, time.time())]
+                return self._next
+            self._cond.wait(self._stallTimeout / 4)
+        return None
+
+    def _drop(self, node: str):
+        # Requests of node go back to the pending batches unless another peer has them
+        self._dropped.add(node)
+        for start in list(self._inFlight):
+            self._finish(start, node)
+
+    def _finish(self, start: int, node: str):
+        requests = [request for request in self._inFlight.get(start, []) if request[0] != node]
+        if requests:
+            self._inFlight[start] = requests
+            return
+        self._inFlight.pop(start, None)
+        if start not in self._arrived and start >= self._next and start not in self._pending:
+            heapq.heappush(self._pending, start)
+
+    def _work(self, client):
+        node = client.node
+        try:
+            while True:
+                with self._cond:
+                    start = self._assign(node)
+                    if start is None:
+                        return
+                batch = self._hashes[start:start + MAX_BLOCKS]
+                try:
+                    blocks = client.get_blocks([xmlrpc.client.Binary(blkHash) for blkHash in batch]) or []
+                except (OSError, xmlrpc.client.Error) as e:
+                    logger.warning("Could not get blocks from %s: %s" % (node, e))
+                    blocks = []
+                blocks = parseBlocks(batch, [blk.data for blk in blocks])
+                with self._cond:
+                    if blocks is None:
+                        logger.warning("Dropping %s, it did not send the blocks asked" % node)
+                        self._drop(node)
+                        return
+                    if start >= self._next and start not in self._arrived:
+                        self._arrived[start] = blocks
+                        self._received[node] = self._received.get(node, 0) + len(blocks)
+                    self._finish(start, node)
+                    self._cond.notify_all()
+        finally:
+            with self._cond:
+                self._workers -= 1
+                self._cond.notify_all()
+
+    def __iter__(self):
+        with self._cond:
+            for client in self._clients:
+                for i in range(self._peerRequests):
+                    # ServerProxy is not thread safe, extra requests get their own
+                    peer = client if i == 0 else RpcClient(client.node)
+                    threading.Thread(target=self._work, args=(peer,), daemon=True).start()
+                    self._workers += 1
+        try:
+            while self._next < len(self._hashes):
+                with self._cond:
+                    while self._next not in self._arrived and self._workers > 0:
+                        self._cond.wait(self._stallTimeout / 4)
+                    blocks = self._arrived.pop(self._next, None)
+                    if blocks is None:
+                        logger.warning("No peer left to download blocks, %d of %d received" %
+                                       (self._next, len(self._hashes)))
+                        return
+                    self._next += MAX_BLOCKS
+                    self._cond.notify_all()
+                for blk in blocks:
+                    yield blk
+        finally:
+            with self._cond:
+                self._closed = True
+                self._cond.notify_all()
+
+
+class HeaderSync:
+    """
+    Headers-first synchronization. Headers are fetched from every peer and
+    checked for proof of work, which costs 76 bytes a block, and only the
+    blocks of the header chain with most work are downloaded. A peer serving
+    a bogus chain is dropped at its first invalid header. Orphan blocks then
+    get their missing ancestors from the peers.
+    """
+
+    def __init__(self, blockchain, clients=None):
+        self._blockchain = blockchain
+        self._clients = list(clients) if clients is not None else get_clients()
+
+    @property
+    def clients(self):
+        return self._clients
+
+    def syncHeaders(self) -> int:
+        # Number of headers accepted over all peers
+        total = 0
+        for client in list(self._clients):
+            try:
+                total += self._syncHeadersFrom(client)
+            except (OSError, xmlrpc.client.Error) as e:
+                logger.warning("Could not get headers from %s: %s" % (client.node, e))
+        return total
+
+    def _syncHeadersFrom(self, client) -> int:
+        total = 0
+        while True:
+            best = self._blockchain.state.index.getBestHeader()
+            headers = client.get_headers(self._blockchain.getLocator(), MAX_HEADERS) or []
+            raw = [header.data for header in headers]
+            accepted = self._blockchain.addHeaders(raw)
+            total += accepted
+            if accepted < len(raw):
+                logger.warning("Dropping %s, it sent an invalid header" % client.node)
+                self._clients.remove(client)
+                return total
+            # A short answer is the peer's tip, a known one has nothing more for us
+            if len(raw) < MAX_HEADERS or self._blockchain.state.index.getBestHeader() is best:
+                return total
+
+    def downloadBlocks(self) -> int:
+        # Connects the missing blocks of the best header chain, returns how many
+        hashes = self._blockchain.getMissingBlocks()
+        if not hashes:
+            return 0
+        downloader = BlockDownloader(self._clients, hashes)
+        connected = self._blockchain.addBlocks(downloader)
+        self._clients = [client for client in self._clients if client.node not in downloader.dropped]
+        return connected
+
+    def fetchOrphanParents(self) -> int:
+        """
+        Asks the peers for the blocks the orphans wait for, each hash once.
+        A parent that is itself an orphan is followed up in the next round.
+        :return: number of blocks fetched
+        """
+        fetched = 0
+        asked = set()
+        while True:
+            missing = [blkHash for blkHash in self._blockchain.getOrphanParents() if blkHash not in asked]
+            if not missing:
+                return fetched
+            for blkHash in missing:
+                asked.add(blkHash)
+                blk = self._fetchBlock(blkHash)
+                if blk is not None:
+                    # Connects the orphans above it, or joins them waiting
+                    self._blockchain.addBlock(blk)
+                    fetched += 1
+
+    def _fetchBlock(self, blkHash: bytes):
+        # First peer that has the block, a peer without it is not at fault
+        for client in self._clients:
+            try:
+                blocks = client.get_blocks([xmlrpc.client.Binary(blkHash)]) or []
+            except (OSError, xmlrpc.client.Error) as e:
+                logger.warning("Could not get block from %s: %s" % (client.node, e))
+                continue
+            blocks = parseBlocks([blkHash], [blk.data for blk in blocks])
+            if blocks is not None:
+                return blocks[0]
+        return None
+
+    def run(self):
+        headers = self.syncHeaders()
+        blocks = self.downloadBlocks()
+        blocks += self.fetchOrphanParents()
+        logger.info("Synchronized %d headers and %d blocks, height %d" %
+                    (headers, blocks, self._blockchain.getMaxHeightBlock().getHeight()))
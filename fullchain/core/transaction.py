@@ -1,19 +1,33 @@
 import binascii
 import collections
+import functools
 import hashlib
 from decimal import *
 
 from Cryptodome.PublicKey import RSA
 
 from fullchain.core.base import Model
-from fullchain.core.exceptions import TransactionSerializeException
 from fullchain.core.utils import int_to_bytes, decimal_to_bytes
 from fullchain.core.utxo import UTXO
 from fullchain.io.binaryreader import BinaryReader
 from fullchain.io.binarywriter import BinaryWriter
 
 
+# Few addresses receive many outputs: their DER encodings and parsed keys are
+# cached, (de)serializing a transaction is otherwise dominated by ASN.1 work
+@functools.lru_cache(maxsize=4096)
+def importAddress(der: bytes) -> RSA.RsaKey:
+    return RSA.importKey(der)
+
+
+@functools.lru_cache(maxsize=4096)
+def exportAddress(n: int, e: int) -> bytes:
+    return RSA.construct((n, e)).exportKey(format='DER')
+
+
 class Input(Model):
+    _pickled = ('_prevTxHash', '_outputIndex', '_signature', '_raw')
+
     def __init__(self, prevHash: bytes = None, index: int = None, signature: bytes = None):
         if prevHash is None:
             self._prevTxHash = b""
@@ -29,6 +43,7 @@ class Input(Model):
             self._signature = b""
         else:
             self._signature = signature
+        self._raw = None
 
     @property
     def prevTxHash(self):
@@ -58,6 +73,13 @@ class Input(Model):
 
     def addSignature(self, sig: bytes):
         self._signature = sig
+        self._raw = None
+
+    def getRawBytes(self) -> bytes:
+        # Canonical encoding used in Transaction.getRawTx, cached until the signature changes
+        if self._raw is None:
+            self._raw = self._prevTxHash + int_to_bytes(self._outputIndex) + self._signature
+        return self._raw
 
     @property
     def __dict__(self) -> dict:
@@ -70,14 +92,15 @@ class Input(Model):
         return collections.OrderedDict(sorted(unordered.items()))
 
     def serialize(self, writer: BinaryWriter):
-        writer.writeBytes(self.prevTxHash)
-        writer.writeUInt8(self.outputIndex)
-        writer.writeBytes(self.signature)
+        writer.writeBytes(self.prevTxHash, unhex=False)
+        writer.writeUInt32(self.outputIndex)
+        writer.writeVarBytes(self.signature)
 
     def deserialize(self, reader: BinaryReader):
         self._prevTxHash = reader.readBytes(32)
-        self._outputIndex = reader.readUInt8()
-        self._signature = reader.readBytes(128)
+        self._outputIndex = reader.readUInt32()
+        self._signature = reader.readVarBytes()
+        self._raw = None
 
 
 class Output(Model):
@@ -90,9 +113,10 @@ class Output(Model):
         if isinstance(pk, RSA.RsaKey):
             self._address = pk
         elif pk is not None:
-            self._address = RSA.importKey(binascii.unhexlify(pk))
+            self._address = importAddress(binascii.unhexlify(pk))
         else:
             self._address = None
+        self._raw = None
 
     @property
     def value(self):
@@ -114,6 +138,15 @@ class Output(Model):
     def __hash__(self):
         return hash((self.value, self.address.e, self.address.n))
 
+    def __getstate__(self):
+        # RsaKey can not be pickled, the key travels as its (n, e) pair
+        address = None if self._address is None else (self._address.n, self._address.e)
+        return {'_value': self._value, '_address': address, '_raw': self._raw}
+
+    def __setstate__(self, state):
+        address = state['_address']
+        super().__setstate__(dict(state, _address=None if address is None else RSA.construct(address)))
+
     @property
     def __dict__(self) -> dict:
         unordered = {
@@ -122,17 +155,57 @@ class Output(Model):
         }
         return collections.OrderedDict(sorted(unordered.items()))
 
+    def getRawBytes(self) -> bytes:
+        # Canonical encoding used in Transaction.getRawTx. Outputs are not
+        # modified after construction, so the decimal encoding of the RSA
+        # modulus is only computed once
+        if self._raw is None:
+            self._raw = (decimal_to_bytes(self._value)
+                         + int_to_bytes(self._address.e)
+                         + int_to_bytes(self._address.n))
+        return self._raw
+
     def serialize(self, writer: BinaryWriter):
         writer.writeVarString(str(self.value))
-        writer.writeVarBytes(self.address.exportKey(format='DER'))
+        writer.writeVarBytes(exportAddress(self.address.n, self.address.e))
 
     def deserialize(self, reader: BinaryReader):
         valueStr = reader.readVarString().decode('utf8')
         self._value = Decimal(valueStr)
-        self._address = RSA.importKey(reader.readVarBytes())
+        self._address = importAddress(reader.readVarBytes())
+        self._raw = None
+
+
+class SigHashContext:
+    """
+    Signature hash data shared by all inputs of a transaction. The outputs are
+    committed to once as the sha256 of their encodings, so the message signed
+    for an input is its outpoint followed by that 32 byte commitment and a
+    transaction with n inputs and m outputs is signed and checked in O(n + m).
+    """
+
+    def __init__(self, tx):
+        md = hashlib.sha256()
+        for op in tx.outputs:
+            md.update(op.getRawBytes())
+        self._outputsHash = md.digest()
+        self._tx = tx
+
+    @property
+    def outputsHash(self):
+        return self._outputsHash
+
+    def getRawDataToSign(self, index: int) -> bytes:
+        # produces data repr for ith=index input and the outputs commitment
+        if index >= self._tx.numInputs():
+            return b""
+
+        inp = self._tx.getInput(index)
+        return inp.prevTxHash + int_to_bytes(inp.outputIndex) + self._outputsHash
 
 
 class Transaction(Model):
+    _pickled = ('_inputs', '_outputs', '_hash', '_coinbase', '_rawTx', '_rawHash')
 
     def __init__(self, tx=None):
         if tx is None:
@@ -144,6 +217,13 @@ class Transaction(Model):
             self._outputs = tx.outputs
             self._hash = tx.hash
         self._coinbase = False
+        self._rawTx = None
+        self._rawHash = None
+        self._sigHashContext = None
+
+    def __setstate__(self, state):
+        super().__setstate__(state)
+        self._sigHashContext = None
 
     @property
     def inputs(self):
@@ -180,67 +260,64 @@ class Transaction(Model):
     def __hash__(self):
         return hash((self._inputs, self._outputs))
 
+    def _invalidate(self):
+        # Drop the cached encoding, every mutator below has to call this
+        self._rawTx = None
+        self._rawHash = None
+
     def addInput(self, prevTxHash, outputIndex):
         inp = Input(prevTxHash, outputIndex)
         self._inputs.append(inp)
+        self._invalidate()
 
     def addOutput(self, value, address):
         op = Output(value, address)
         self._outputs.append(op)
+        self._sigHashContext = None
+        self._invalidate()
 
     def addSignature(self, signature, index):
         self._inputs[index].addSignature(signature)
+        self._invalidate()
 
     def removeInput(self, index: int):
         if index >= len(self._inputs):
             raise AttributeError("Index out of range")
         self._inputs = self._inputs[:index] + self._inputs[index + 1:]
+        self._invalidate()
 
     def removeInputWithUTXO(self, ut: UTXO):
         for index, inp in enumerate(self._inputs):
             u = UTXO(inp.prevTxHash, inp.outputIndex)
             if u == ut:
                 self._inputs = self._inputs[:index] + self._inputs[index + 1:]
+                self._invalidate()
                 return
 
-    def getRawDataToSign(self, index: int) -> bytes:
-        # produces data repr for  ith=index input and all outputs
-        sigData = b""
-        if index > len(self._inputs):
-            return sigData
-
-        inp = self.inputs[index]
-        sigData += inp.prevTxHash
-        sigData += int_to_bytes(inp.outputIndex)
+    def getSigHashContext(self) -> SigHashContext:
+        # Only depends on the outputs, so signing inputs one by one keeps it
+        if self._sigHashContext is None:
+            self._sigHashContext = SigHashContext(self)
+        return self._sigHashContext
 
-        for op in self.outputs:
-            sigData += decimal_to_bytes(op.value)
-            # using pycryptodome lib
-            # e: RSA public exponent
-            sigData += int_to_bytes(op.address.e)
-            # n: RSA modulus
-            sigData += int_to_bytes(op.address.n)
-
-        return sigData
+    def getRawDataToSign(self, index: int) -> bytes:
+        return self.getSigHashContext().getRawDataToSign(index)
 
     def getRawTx(self) -> bytes:
-        rawTx = b""
-        for inp in self.inputs:
-            rawTx += inp.prevTxHash
-            rawTx += int_to_bytes(inp.outputIndex)
-            rawTx += inp.signature
-
-        for op in self.outputs:
-            rawTx += decimal_to_bytes(op.value)
-            rawTx += int_to_bytes(op.address.e)
-            rawTx += int_to_bytes(op.address.n)
-
-        return rawTx
+        if self._rawTx is None:
+            parts = [inp.getRawBytes() for inp in self.inputs]
+            parts.extend(op.getRawBytes() for op in self.outputs)
+            self._rawTx = b"".join(parts)
+        return self._rawTx
+
+    def getRawHash(self) -> bytes:
+        # sha256 of getRawTx, what finalize stores as the transaction hash
+        if self._rawHash is None:
+            self._rawHash = hashlib.sha256(self.getRawTx()).digest()
+        return self._rawHash
 
     def finalize(self):
-        md = hashlib.sha256()
-        md.update(self.getRawTx())
-        self._hash = md.digest()
+        self._hash = self.getRawHash()
 
     def getInput(self, index: int) -> Input:
         return self.inputs[index]
@@ -259,10 +336,7 @@ class Transaction(Model):
 
     @property
     def isValid(self) -> bool:
-        md = hashlib.sha256()
-        md.update(self.getRawTx())
-        hashed_raw_txn = md.digest()
-        return self.hash == hashed_raw_txn
+        return self.hash == self.getRawHash()
 
     def serialize(self, writer: BinaryWriter):
         writer.writeSerializableArray(self.inputs)
@@ -273,9 +347,10 @@ class Transaction(Model):
         self._inputs = reader.readSerializableArray('fullchain.core.transaction.Input')
         self._outputs = reader.readSerializableArray('fullchain.core.transaction.Output')
         self._coinbase = reader.readBool()
-
-        if self.isValid:
-            raise TransactionSerializeException
+        self._sigHashContext = None
+        self._invalidate()
+        # The hash is not serialized, it is the hash of the raw transaction
+        self.finalize()
         return self
 
     # Additional method
@@ -1,17 +1,386 @@
+import decimal
+import heapq
+import itertools
+import os
+import time
+from collections import OrderedDict
+
+from fullchain.core import settings
 from fullchain.core.transaction import Transaction
+from fullchain.core.utxo import UTXO
+from fullchain.io.binaryreader import BinaryReader
+from fullchain.io.binarywriter import BinaryWriter
+
+
+class PoolEntry:
+    # A pooled transaction with what eviction and block assembly need. The
+    # ancestor totals cover the entry and every pooled transaction it spends
+    # from, directly or not. validated is set once structure, inputs and
+    # signatures passed against the latest block and the pool
+    __slots__ = ('tx', 'fee', 'size', 'feeRate', 'time', 'sequence', 'ancestorFee', 'ancestorSize', 'version',
+                 'validated')
+
+    def __init__(self, tx: Transaction, fee: decimal.Decimal, time: float, sequence: int, validated: bool = False):
+        self.tx = tx
+        self.fee = fee
+        self.size = len(tx.getRawTx())
+        self.feeRate = fee / self.size
+        self.time = time
+        self.sequence = sequence
+        self.ancestorFee = fee
+        self.ancestorSize = self.size
+        self.version = 0
+        self.validated = validated
+
+    @property
+    def ancestorFeeRate(self):
+        return self.ancestorFee / self.ancestorSize
+
+
+class MempoolUTXOView:
+    """
+    Read only UTXO set of the latest block with the pool applied on top:
+    outputs of pooled transactions are added and outpoints they spend are
+    gone. A transaction validates against it as the next one of a block
+    holding the whole pool, so unconfirmed chains pass and conflicts fail.
+    Outpoints spent by `exclude` stay, to check a pooled transaction again.
+    """
+
+    def __init__(self, utxos, pool, exclude: bytes = None):
+        self._utxos = utxos
+        self._pool = pool
+        self._exclude = exclude
+
+    def _isSpent(self, utxo: UTXO):
+        spender = self._pool.getSpender(utxo)
+        return spender is not None and spender != self._exclude
+
+    def getTxOutput(self, utxo: UTXO):
+        if self._isSpent(utxo):
+            return None
+        txOut = self._utxos.getTxOutput(utxo)
+        if txOut is None:
+            txOut = self._pool.getTxOutput(utxo)
+        return txOut
+
+    def contains(self, utxo: UTXO):
+        return self.getTxOutput(utxo) is not None
+
+    def getAllUTXO(self):
+        res = [utxo for utxo in self._utxos.getAllUTXO() if not self._isSpent(utxo)]
+        for tx in self._pool.getTransactions():
+            for i in range(len(tx.outputs)):
+                utxo = UTXO(tx.hash, i)
+                if not self._isSpent(utxo):
+                    res.append(utxo)
+        return res
+
 
 class TransactionPool:
-    def __init__(self):
-        self._map = dict()
-    
-    def addTransaction(self, tx: Transaction):
-        self._map[tx.hash] = tx
+    """
+    Unconfirmed transactions, oldest first. The pool is bounded in bytes: past the cap the entries paying
+    the lowest fee per byte are evicted, together with their descendants.
+    Entries older than `expiry` seconds are dropped on the next insertion.
+    Every spent outpoint maps to its spender, which makes conflict checks and
+    the removal of a connected block's transactions O(inputs). Ancestor
+    totals are kept up to date on every change, with a heap ordering the
+    entries by ancestor fee rate for the BlockAssembler.
+    """
+    # Dump file: magic, version, count, then per entry its arrival time and transaction
+    FILE_MAGIC = b'FCMP'
+    FILE_VERSION = 1
+
+    def __init__(self, maxBytes: int = None, expiry: int = None):
+        self._maxBytes = maxBytes if maxBytes is not None else settings.MEMPOOL_MAX_BYTES
+        self._expiry = expiry if expiry is not None else settings.MEMPOOL_EXPIRY
+        self._map = OrderedDict()
+        # UTXO -> hash of the pooled transaction spending it
+        self._spenders = dict()
+        # (fee rate, sequence, hash) of every entry, removed ones skipped lazily
+        self._byFeeRate = []
+        # (-ancestor fee rate, sequence, version, hash), outdated versions skipped lazily
+        self._byAncestorScore = []
+        self._sequence = itertools.count()
+        self._bytes = 0
+        # Called with (added, removed) transactions after every change
+        self._listeners = []
+        self._removed = []
+
+    def __len__(self):
+        return len(self._map)
+
+    def __contains__(self, txHash: bytes):
+        return txHash in self._map
+
+    @property
+    def bytes(self):
+        return self._bytes
+
+    @property
+    def expiry(self):
+        return self._expiry
+
+    def addListener(self, listener):
+        self._listeners.append(listener)
+
+    def _notify(self, added=()):
+        removed = self._removed
+        self._removed = []
+        if added or removed:
+            for listener in self._listeners:
+                listener(list(added), removed)
+
+    def addTransaction(self, tx: Transaction, fee=decimal.Decimal(0), now: float = None,
+                       validated: bool = False) -> bool:
+        """
+        Adds tx unless it is already pooled or spends an outpoint a pooled
+        transaction spends. Returns False as well when tx itself is evicted
+        to stay under the byte cap.
+        """
+        if tx.hash in self._map or self.getConflicts(tx):
+            return False
+        if now is None:
+            now = time.time()
+        self.expire(now)
+        entry = PoolEntry(tx, fee, now, next(self._sequence), validated)
+        self._map[tx.hash] = entry
+        for inp in tx.inputs:
+            self._spenders[UTXO(inp.prevTxHash, inp.outputIndex)] = tx.hash
+        heapq.heappush(self._byFeeRate, (entry.feeRate, entry.sequence, tx.hash))
+        self._bytes += entry.size
+        for ancestor in self.getAncestors(tx.hash):
+            other = self._map[ancestor]
+            entry.ancestorFee += other.fee
+            entry.ancestorSize += other.size
+        self._pushScore(entry)
+        # Children already pooled when a reorganization returns their parent
+        for descendant in self.getDescendants(tx.hash):
+            self._updateAncestors(self._map[descendant], entry.fee, entry.size)
+        self.trim()
+        added = tx.hash in self._map
+        self._notify([tx] if added else [])
+        return added
 
     def removeTransaction(self, txHash):
-        self._map.pop(txHash)
+        # Removes txHash alone, its pooled children are left in place
+        entry = self._map[txHash]
+        for descendant in self.getDescendants(txHash):
+            self._updateAncestors(self._map[descendant], -entry.fee, -entry.size)
+        tx = self._remove(txHash)
+        self._notify()
+        return tx
 
-    def getTransaction(self, txHash):
+    def _remove(self, txHash):
+        entry = self._map.pop(txHash)
+        for inp in entry.tx.inputs:
+            utxo = UTXO(inp.prevTxHash, inp.outputIndex)
+            if self._spenders.get(utxo) == txHash:
+                del self._spenders[utxo]
+        self._bytes -= entry.size
+        if len(self._byFeeRate) > 2 * len(self._map) + 16:
+            self._byFeeRate = [item for item in self._byFeeRate if item[2] in self._map]
+            heapq.heapify(self._byFeeRate)
+        if len(self._byAncestorScore) > 2 * len(self._map) + 16:
+            self._byAncestorScore = [item for item in self._byAncestorScore if self.isCurrentScore(item)]
+            heapq.heapify(self._byAncestorScore)
+        self._removed.append(entry.tx)
+        return entry.tx
+
+    def _updateAncestors(self, entry: PoolEntry, fee, size: int):
+        entry.ancestorFee += fee
+        entry.ancestorSize += size
+        self._pushScore(entry)
+
+    def _pushScore(self, entry: PoolEntry):
+        entry.version += 1
+        heapq.heappush(self._byAncestorScore,
+                       (-entry.ancestorFeeRate, entry.sequence, entry.version, entry.tx.hash))
+
+    def isCurrentScore(self, item) -> bool:
+        entry = self._map.get(item[3])
+        return entry is not None and entry.version == item[2]
+
+    def getCandidates(self):
+        # Copy of the ancestor score heap, best first once popped
+        return list(self._byAncestorScore)
+
+    def removeWithDescendants(self, txHash):
+        # Removes txHash and every pooled transaction spending its outputs
+        if txHash not in self._map:
+            return []
+        # Descendants all go too, their ancestor totals need no update
+        doomed = [txHash] + list(self.getDescendants(txHash))
+        removed = [self._remove(doomedHash) for doomedHash in doomed]
+        self._notify()
+        return removed
+
+    def removeForBlock(self, txs):
+        """
+        Drops the transactions of a connected block and the pooled ones that
+        spend the same outpoints, with their descendants. Children of the
+        confirmed transactions stay, their inputs now are in the UTXO set.
+        """
+        removed = []
+        for tx in txs:
+            if tx.hash in self._map:
+                removed.append(self.removeTransaction(tx.hash))
+            for spender in self.getConflicts(tx):
+                removed.extend(self.removeWithDescendants(spender))
+        return removed
+
+    def removeUnspendable(self, utxos):
+        """
+        After a reorganization, drops the transactions spending outputs that
+        are neither in utxos nor pooled, with their descendants.
+        """
+        removed = []
+        for tx in self.getTransactions():
+            if tx.hash not in self._map:
+                continue
+            for inp in tx.inputs:
+                utxo = UTXO(inp.prevTxHash, inp.outputIndex)
+                if not utxos.contains(utxo) and self.getTxOutput(utxo) is None:
+                    removed.extend(self.removeWithDescendants(tx.hash))
+                    break
+        return removed
+
+    def getConflicts(self, tx: Transaction):
+        # Hashes of the other pooled transactions spending an input of tx
+        conflicts = set()
+        for inp in tx.inputs:
+            spender = self._spenders.get(UTXO(inp.prevTxHash, inp.outputIndex))
+            if spender is not None and spender != tx.hash:
+                conflicts.add(spender)
+        return conflicts
+
+    def getParents(self, tx: Transaction):
+        return set(inp.prevTxHash for inp in tx.inputs if inp.prevTxHash in self._map)
+
+    def getAncestors(self, txHash):
+        # Pooled transactions txHash spends from, directly or not
+        ancestors = set()
+        stack = list(self.getParents(self._map[txHash].tx))
+        while stack:
+            parent = stack.pop()
+            if parent not in ancestors:
+                ancestors.add(parent)
+                stack.extend(self.getParents(self._map[parent].tx))
+        return ancestors
+
+    def getDescendants(self, txHash):
+        # Pooled transactions spending from txHash, directly or not
+        descendants = set()
+        stack = self.getChildren(self._map[txHash].tx)
+        while stack:
+            child = stack.pop()
+            if child not in descendants:
+                descendants.add(child)
+                stack.extend(self.getChildren(self._map[child].tx))
+        return descendants
+
+    def getChildren(self, tx: Transaction):
+        children = []
+        for i in range(len(tx.outputs)):
+            spender = self._spenders.get(UTXO(tx.hash, i))
+            if spender is not None:
+                children.append(spender)
+        return children
+
+    def getSpender(self, utxo: UTXO):
+        return self._spenders.get(utxo)
+
+    def getTxOutput(self, utxo: UTXO):
+        # Output of a pooled transaction, None if it is not pooled
+        entry = self._map.get(utxo.getTxHash())
+        if entry is None or utxo.getIndex() >= len(entry.tx.outputs):
+            return None
+        return entry.tx.outputs[utxo.getIndex()]
+
+    def trim(self):
+        # Evicts the lowest fee rates, with their descendants, until under the byte cap
+        while self._bytes > self._maxBytes and self._byFeeRate:
+            _, _, txHash = heapq.heappop(self._byFeeRate)
+            if txHash in self._map:
+                self.removeWithDescendants(txHash)
+        self._notify()
+
+    def expire(self, now: float = None):
+        if now is None:
+            now = time.time()
+        while self._map:
+            txHash, entry = next(iter(self._map.items()))
+            if now - entry.time < self._expiry:
+                break
+            self.removeWithDescendants(txHash)
+        self._notify()
+
+    def getParentsFirst(self):
+        """
+        Entries in pool order, except that every entry follows its pooled
+        parents. Pool order alone is not enough: a reorganization puts
+        parents back behind children that stayed pooled.
+        """
+        ordered = []
+        done = set()
+        for txHash in self._map:
+            stack = [(txHash, False)]
+            while stack:
+                current, expanded = stack.pop()
+                if current in done:
+                    continue
+                if expanded:
+                    done.add(current)
+                    ordered.append(self._map[current])
+                    continue
+                stack.append((current, True))
+                stack.extend((parent, False) for parent in self.getParents(self._map[current].tx)
+                             if parent not in done)
+        return ordered
+
+    def dump(self, path: str) -> int:
+        """
+        Writes the pool to path, parents before their children so that it
+        loads back through admission, through a temporary file so that a
+        crash while writing leaves the previous dump intact.
+        :return: <int> number of transactions written
+        """
+        entries = self.getParentsFirst()
+        tmpPath = path + '.new'
+        with open(tmpPath, 'wb') as f:
+            writer = BinaryWriter(f)
+            writer.writeBytes(TransactionPool.FILE_MAGIC, unhex=False)
+            writer.writeUInt32(TransactionPool.FILE_VERSION)
+            writer.writeVarInt(len(entries))
+            for entry in entries:
+                writer.writeUInt64(int(entry.time))
+                entry.tx.serialize(writer)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmpPath, path)
+        return len(entries)
+
+    @staticmethod
+    def readDump(path: str):
+        # Streams (transaction, arrival time) pairs out of a dump, parents first
+        with open(path, 'rb') as f:
+            reader = BinaryReader(f)
+            if reader.readBytes(len(TransactionPool.FILE_MAGIC)) != TransactionPool.FILE_MAGIC:
+                raise ValueError("%s is not a transaction pool dump" % path)
+            version = reader.readUInt32()
+            if version != TransactionPool.FILE_VERSION:
+                raise ValueError("Unsupported transaction pool dump version %d" % version)
+            for _ in range(reader.readVarInt()):
+                arrival = reader.readUInt64()
+                tx = Transaction()
+                tx.deserialize(reader)
+                yield tx, arrival
+
+    def getEntry(self, txHash):
         return self._map.get(txHash)
 
+    def getTransaction(self, txHash):
+        entry = self._map.get(txHash)
+        return None if entry is None else entry.tx
+
     def getTransactions(self):
-        return list(self._map.values())
+        return [entry.tx for entry in self._map.values()]
@@ -1,43 +1,146 @@
-import copy
 import decimal
+import time
 
-from fullchain.core.utxo import UTXO, UTXOPool
+from fullchain.core.utxo import UTXO, UTXOPool, UTXOPoolView
 from fullchain.core.transaction import Transaction
-from fullchain.core.crypto import Crypto
+from fullchain.core.crypto import Crypto, BatchVerifier
 
-class TxHandler:
-    def __init__(self, pool: UTXOPool):
-        self._pool = pool
+class ValidationStats:
+    """
+    Rejections and time spent per stage of TxHandler.isValidTx, one instance
+    can be shared by several handlers to aggregate over a run.
+    """
+    STAGES = ('structure', 'inputs', 'signatures')
 
-    def isValidTx(self, tx: Transaction) -> bool:
-        inputSum = decimal.Decimal()
-        pool = copy.deepcopy(self._pool)
-        for (index, inp) in enumerate(tx.inputs):
-            utxo = UTXO(inp.prevTxHash, inp.outputIndex)
+    def __init__(self):
+        self.checked = 0
+        self.rejected = {stage: 0 for stage in ValidationStats.STAGES}
+        self.seconds = {stage: 0.0 for stage in ValidationStats.STAGES}
 
-            if not pool.contains(utxo):
-                return False
+    def record(self, stage: str, seconds: float, passed: bool):
+        self.seconds[stage] += seconds
+        if not passed:
+            self.rejected[stage] += 1
+
+    def __str__(self):
+        return '%d checked, ' % self.checked + ', '.join(
+            '%s: %d rejected in %.3fs' % (stage, self.rejected[stage], self.seconds[stage])
+            for stage in ValidationStats.STAGES)
 
-            output = pool.getTxOutput(utxo)
 
-            pubKey = output.address
-            message = tx.getRawDataToSign(index)
-            if not Crypto.verifySignature(pubKey, message, inp.signature):
+class TxHandler:
+    def __init__(self, pool: UTXOPool, verifier: BatchVerifier = None, stats: ValidationStats = None,
+                 verifySignatures: bool = True):
+        # Accepted transactions are applied to an overlay, the caller's pool
+        # only changes if it commits getUTXOPool()
+        self._pool = UTXOPoolView(pool)
+        self._verifier = verifier
+        self._stats = stats if stats is not None else ValidationStats()
+        # False for blocks covered by the assume-valid block
+        self._verifySignatures = verifySignatures
+
+    def getUTXOPool(self) -> UTXOPoolView:
+        return self._pool
+
+    @property
+    def stats(self) -> ValidationStats:
+        return self._stats
+
+    @staticmethod
+    def checkStructure(tx: Transaction) -> bool:
+        # Stateless: no negative output and no outpoint spent twice by tx
+        for out in tx.outputs:
+            if out.value < 0:
                 return False
+        outpoints = set((inp.prevTxHash, inp.outputIndex) for inp in tx.inputs)
+        return len(outpoints) == len(tx.inputs)
 
+    def checkInputs(self, tx: Transaction):
+        # Every input is unspent and they cover the outputs, returns the spent outputs
+        spent = []
+        inputSum = decimal.Decimal()
+        for inp in tx.inputs:
+            output = self._pool.getTxOutput(UTXO(inp.prevTxHash, inp.outputIndex))
+            if output is None:
+                return None
             inputSum += output.value
-            pool.removeUTXO(utxo)
+            spent.append(output)
 
         outputSum = decimal.Decimal()
         for out in tx.outputs:
-            if out.value < 0:
-                return False
             outputSum += out.value
 
-        return inputSum >= outputSum
+        if inputSum < outputSum:
+            return None
+        return spent
+
+    @staticmethod
+    def checkSignatures(tx: Transaction, spent) -> bool:
+        sigHash = tx.getSigHashContext()
+        for (index, inp) in enumerate(tx.inputs):
+            message = sigHash.getRawDataToSign(index)
+            if not Crypto.verifySignature(spent[index].address, message, inp.signature):
+                return False
+        return True
+
+    def isValidTx(self, tx: Transaction) -> bool:
+        """
+        Runs the stages from the cheapest to the most expensive, so malformed
+        transactions and double spends are rejected before any RSA work.
+        """
+        stats = self._stats
+        stats.checked += 1
+
+        start = time.perf_counter()
+        ok = TxHandler.checkStructure(tx)
+        now = time.perf_counter()
+        stats.record('structure', now - start, ok)
+        if not ok:
+            return False
 
+        start = now
+        spent = self.checkInputs(tx)
+        now = time.perf_counter()
+        stats.record('inputs', now - start, spent is not None)
+        if spent is None:
+            return False
+        if not self._verifySignatures:
+            return True
+
+        start = now
+        ok = TxHandler.checkSignatures(tx, spent)
+        stats.record('signatures', time.perf_counter() - start, ok)
+        return ok
+
+    def prefetchSignatures(self, txs):
+        """
+        Checks the signatures of every input of txs in one batch with the
+        verifier. Keys are resolved against the pool and the outputs of earlier
+        transactions of the batch, the valid signatures land in Crypto.sigCache
+        and the sequential pass of handleTxs then takes the same decisions it
+        would take without prefetching, only without the RSA work.
+        """
+        created = dict()
+        jobs = []
+        for tx in txs:
+            if not TxHandler.checkStructure(tx):
+                continue
+            sigHash = tx.getSigHashContext()
+            for (index, inp) in enumerate(tx.inputs):
+                utxo = UTXO(inp.prevTxHash, inp.outputIndex)
+                output = created.get(utxo)
+                if output is None:
+                    output = self._pool.getTxOutput(utxo)
+                if output is None:
+                    continue
+                jobs.append((output.address, sigHash.getRawDataToSign(index), inp.signature))
+            for (i, out) in enumerate(tx.outputs):
+                created[UTXO(tx.hash, i)] = out
+        self._verifier.verify(jobs)
 
     def handleTxs(self, txs):
+        if self._verifier is not None and self._verifySignatures:
+            self.prefetchSignatures(txs)
         result = []
         for tx in txs:
             if self.isValidTx(tx):
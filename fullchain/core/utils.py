@@ -19,8 +19,9 @@ def int_to_bytes(s: int) -> bytes:
 
 
 def sign(privateKey, tx, index):
-    # Takes msg and sk and outputs signature for msg
-    hashMsg = SHA256.new(tx.getRawDataToSign(index))
+    # Takes msg and sk and outputs signature for msg, the signature hash
+    # context is cached on tx so signing every input stays linear
+    hashMsg = SHA256.new(tx.getSigHashContext().getRawDataToSign(index))
     signer = PKCS1_v1_5.new(privateKey)
     signature = signer.sign(hashMsg)
     return signature
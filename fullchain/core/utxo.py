@@ -57,3 +57,73 @@ class UTXOPool:
 
     def getAllUTXO(self):
         return list(self._map.keys())
+
+
+class UTXOPoolView:
+    """
+    Copy-on-write view over a UTXOPool (or another view). Spends and
+    creations are recorded in the view and the base is left untouched until
+    commit(), so validating against it costs O(changes) instead of a copy of
+    the whole UTXO set.
+    """
+
+    def __init__(self, base):
+        self._base = base
+        self._added = dict()
+        self._removed = set()
+
+    @property
+    def base(self):
+        return self._base
+
+    @property
+    def added(self):
+        # UTXOs created in this view, mapped to their outputs
+        return self._added
+
+    @property
+    def removed(self):
+        # UTXOs of the base spent in this view
+        return self._removed
+
+    def addUTXO(self, utxo: UTXO, txOut):
+        self._added[utxo] = txOut
+
+    def removeUTXO(self, utxo: UTXO):
+        if not self.contains(utxo):
+            raise KeyError(utxo)
+        self._added.pop(utxo, None)
+        if self._base.contains(utxo):
+            self._removed.add(utxo)
+
+    def getTxOutput(self, utxo: UTXO):
+        txOut = self._added.get(utxo)
+        if txOut is not None or utxo in self._removed:
+            return txOut
+        return self._base.getTxOutput(utxo)
+
+    def contains(self, utxo: UTXO):
+        if utxo in self._added:
+            return True
+        return utxo not in self._removed and self._base.contains(utxo)
+
+    def getAllUTXO(self):
+        res = [utxo for utxo in self._base.getAllUTXO()
+               if utxo not in self._removed and utxo not in self._added]
+        res.extend(self._added.keys())
+        return res
+
+    def applyTo(self, pool):
+        # Replays the recorded changes on `pool`, which must hold the base's UTXOs
+        for utxo in self._removed:
+            pool.removeUTXO(utxo)
+        for utxo, txOut in self._added.items():
+            pool.addUTXO(utxo, txOut)
+
+    def commit(self):
+        self.applyTo(self._base)
+        self.discard()
+
+    def discard(self):
+        self._added = dict()
+        self._removed = set()
@@ -1,6 +1,7 @@
 import binascii
 
 from fullchain.core.block import Block
+from fullchain.core.exceptions import BlockInvalidException
 from fullchain.io.helper import Helper
 from fullchain.logs.logging import log_manager
 from fullchain.storage.dbprefix import DBPrefix
@@ -18,6 +19,15 @@ def getBlockByHash(db, blockHash):
     return None
 
 
+def getHeaderByHeight(db, height):
+    # Raw header of the final block at height, None if there is none
+    try:
+        return db.get(DBPrefix.DATA_HEADER_BY_HEIGHT + height.to_bytes(4, 'big'))
+    except Exception as e:
+        logger.error("Could not get header %s " % e)
+    return None
+
+
 def storeTransactionIndex(db, txnHash, blockHash, txnIndex):
     try:
         with db.getBatch() as tx_wb:
@@ -30,13 +40,37 @@ def storeTransactionIndex(db, txnHash, blockHash, txnIndex):
 
 def storeBlock(db, block: Block):
     try:
-        if block.isValid:
+        if block.isValid():
             with db.getBatch() as blockWb:
                 blockWb.put(DBPrefix.DATA_BLOCK + block.getHash(), block.toByteArray())
+                blockWb.put(DBPrefix.DATA_HEADER_BY_HEIGHT + block.getHeight().to_bytes(4, 'big'),
+                            block.getRawHeader())
 
-                for txnIdx, txn in enumerate(block.getTransactions):
+                for txnIdx, txn in enumerate(block.getTransactions()):
                     storeTransactionIndex(db, txn.hash, block.getHash(), txnIdx)
             return True
     except Exception as e:
         logger.error("Could not store block because %s " % e)
     return False
+
+
+def storeBlocks(db, blocks):
+    """
+    Stores blocks and their transaction indexes in a single write batch,
+    nothing is written if one of them is invalid.
+    """
+    try:
+        with db.getBatch() as blockWb:
+            for block in blocks:
+                if not block.isValid():
+                    raise BlockInvalidException
+                blockWb.put(DBPrefix.DATA_BLOCK + block.getHash(), block.toByteArray())
+                blockWb.put(DBPrefix.DATA_HEADER_BY_HEIGHT + block.getHeight().to_bytes(4, 'big'),
+                            block.getRawHeader())
+
+                for txnIdx, txn in enumerate(block.getTransactions()):
+                    blockWb.put(DBPrefix.DATA_TXN_INDEX + txn.hash, block.getHash() + txnIdx.to_bytes(4, 'little'))
+        return True
+    except Exception as e:
+        logger.error("Could not store blocks because %s " % e)
+    return False
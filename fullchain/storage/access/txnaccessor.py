@@ -27,5 +27,32 @@ def getTransaction(db, txnHash):
     return None
 
 
+def getTransactionProof(db, txnHash):
+    """
+    Returns (header, index, size, proof) so a light client holding only block
+    headers can check with Block.verifyTransactionProof that the transaction
+    is part of the block, None if the transaction is unknown.
+    """
+    try:
+        out = db.get(DBPrefix.DATA_TXN_INDEX + txnHash)
+        if out is not None:
+            out = bytearray(out)
+            blockHash = bytes(out[:-4])
+            index = int.from_bytes(out[-4:], 'little')
+
+            block = getBlockByHash(db, blockHash)
+            if block is None:
+                raise BlockInvalidException
+
+            if len(block.getTransactions()) <= index:
+                raise TransactionInvalidException
+
+            proof, size = block.getTransactionProof(index)
+            return block.getHeader(), index, size, proof
+    except Exception as e:
+        logger.error("Could not get transaction proof %s " % e)
+    return None
+
+
 def containTransaction(db, txnHash):
     return getTransaction(db, txnHash) is not None
@@ -1,3 +1,4 @@
 class DBPrefix:
     DATA_BLOCK = b'\x01'
     DATA_TXN_INDEX = b'\x02'
+    DATA_HEADER_BY_HEIGHT = b'\x03'